@@ -0,0 +1,61 @@
+"""
+This script derives a lower resolution array version from an existing one, e.g. ../static/arrays/v0.2.0,
+without the raw Level II scans: arrays are optionally center cropped to a smaller range, then averaged over
+blocks of pixels (ignoring NaN, see wsrdata.utils.array_pyramid). For example, --factor 2 turns 600 x 600 arrays
+of 150 km into 300 x 300 arrays, and --crop_r_max 75000 --factor 1 keeps the central 75 km at full resolution.
+The new version is recorded in ../static/arrays/previous_versions.json with its derived configs.
+Derived values approximate, but do not equal, rendering at the lower resolution from raw scans.
+Rerunning the script only adds scans that are not derived yet.
+"""
+
+import argparse
+import json
+import os
+from wsrdata.utils.array_pyramid import derive_array_tree
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--src_version", type=str, required=True, help="existing array version, e.g. v0.2.0")
+parser.add_argument("--dst_version", type=str, required=True, help="new array version, e.g. v0.2.0_300")
+parser.add_argument("--factor", type=int, default=2, help="block size of the averaging, e.g. 2 for 600 -> 300")
+parser.add_argument("--crop_r_max", type=float, default=None,
+                    help="optional range in meters of a centered window to crop to before averaging")
+parser.add_argument("--scan_list", type=str, default=None,
+                    help="optional txt file of scans to derive, one per line; default walks the source version")
+parser.add_argument("--arrays_root", type=str, default="../static/arrays", help="directory of array versions")
+args = parser.parse_args()
+
+with open(os.path.join(args.arrays_root, "previous_versions.json"), "r") as f:
+    previous_versions = json.load(f)
+src_config = previous_versions[args.src_version]
+
+# configs of the derived version; products of the source are cropped and averaged alike
+dst_config = dict(src_config, derived_from={"version": args.src_version, "factor": args.factor,
+                                            "crop_r_max": args.crop_r_max})
+dst_config.pop("pyramid", None)
+crop = None
+for product in ("array", "dualpol"):
+    config = dict(src_config[product])
+    if args.crop_r_max is not None:
+        assert args.crop_r_max <= config["r_max"], "crop_r_max must not exceed the r_max of the source version"
+        crop = int(round(config["dim"] * args.crop_r_max / config["r_max"]))
+        config["dim"], config["r_max"] = crop, args.crop_r_max
+    assert config["dim"] % args.factor == 0, f"dim {config['dim']} is not divisible by factor {args.factor}"
+    config["dim"] //= args.factor
+    dst_config[product] = config
+assert src_config["array"]["dim"] == src_config["dualpol"]["dim"] and \
+       src_config["array"]["r_max"] == src_config["dualpol"]["r_max"], "array and dualpol grids must agree"
+
+# make sure there is no config conflict, as in prepare_dataset_v0.2.0.py
+if args.dst_version in previous_versions:
+    assert previous_versions[args.dst_version] == json.loads(json.dumps(dst_config))
+else:
+    previous_versions[args.dst_version] = dst_config
+    with open(os.path.join(args.arrays_root, "previous_versions.json"), "w") as f:
+        json.dump(previous_versions, f)
+
+scans = None
+if args.scan_list:
+    scans = [scan.strip() for scan in open(args.scan_list, "r").readlines() if scan.strip()]
+n = derive_array_tree(os.path.join(args.arrays_root, args.src_version), os.path.join(args.arrays_root, args.dst_version),
+                      args.factor, crop, scans)
+print(f"Derived {n} scans of {args.dst_version} from {args.src_version}")
@@ -11,6 +11,7 @@ import argparse
 import json
 import numpy as np
 import os
+from wsrdata.utils.array_io import ArrayReader
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--station", type=str, required=True, help="station name")
@@ -52,6 +53,7 @@ print(f'There are {len(station_years)} years for station {args.station} from the
 print(f'Sample station-years: {list(station_years.keys())[:5]}.\n')
 
 # For each station-year of interest, read the corresponding scan list
+reader = ArrayReader(ARRAY_NPZ_DIR) # with npy arrays, only the needed channel is read from disk
 for station_year in station_years:
     station, year = station_year.split("_")
     # Read the list of scans with successfully rendered arrays for relevant months of this station-year.
@@ -62,12 +64,10 @@ for station_year in station_years:
         scan = scan.strip().split(",")[0]
         if int(scan[8:10]) < MONTHS[0] or int(scan[8:10]) > MONTHS[1]:
             continue
-        npz_path = os.path.join(ARRAY_NPZ_DIR, f'{scan[4:8]}/{scan[8:10]}/{scan[10:12]}/{scan[:4]}/{scan}.npz')
-        assert os.path.exists(npz_path), f'{scan} does not have an npz'
-        arrays = np.load(npz_path)
+        assert reader.exists(scan, 'array'), f'{scan} does not have an npz'
         station_years[station_year]['all_scans_with_check'][scan] = {
-            'avg_dbz':  np.mean(np.nan_to_num(arrays['array'][0, 0, :, :], copy=False, nan=0.0)),
-            'dualpol':  'dualpol_array' in arrays,
+            'avg_dbz':  np.mean(np.nan_to_num(reader.read(scan, 'array', (0, 0)), copy=False, nan=0.0)),
+            'dualpol':  reader.exists(scan, 'dualpol_array'),
         }
         if scan[4:12] not in station_years[station_year]['all_days_to_scans']:
             station_years[station_year]['all_days_to_scans'][scan[4:12]] = set()
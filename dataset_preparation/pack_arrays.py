@@ -0,0 +1,24 @@
+"""
+This script copies the npz files of an array version, e.g. ../static/arrays/v0.2.0, into a pack:
+a few large append-only shard files plus a sqlite index of scan offsets (see wsrdata.utils.array_pack).
+Packs avoid per-scan files and deep directory walks, which are slow on shared or network filesystems.
+Read packed arrays with wsrdata.utils.array_pack.PackReader, by scan (read, load) or sequentially (stream).
+Rerunning the script only adds scans that are not packed yet.
+"""
+
+import argparse
+from wsrdata.utils.array_pack import pack_array_tree
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--array_dir", type=str, required=True, help="array version directory with npz files")
+parser.add_argument("--pack_dir", type=str, required=True, help="output directory for shards and their index")
+parser.add_argument("--scan_list", type=str, default=None,
+                    help="optional txt file of scans to pack, one per line; default walks array_dir")
+parser.add_argument("--shard_gb", type=float, default=1.0, help="size at which a new shard is started")
+args = parser.parse_args()
+
+scans = None
+if args.scan_list:
+    scans = [scan.strip() for scan in open(args.scan_list, "r").readlines() if scan.strip()]
+n = pack_array_tree(args.array_dir, args.pack_dir, scans, shard_bytes=int(args.shard_gb * (1 << 30)))
+print(f"Packed {n} scans from {args.array_dir} into {args.pack_dir}")
@@ -1,6 +1,9 @@
 """
 Download and render for scans listed in SCAN_LIST_PATH
 Launch this scripts multiple times in parallel for accelerated dataset creation
+With WORK_QUEUE_DIR on a filesystem shared by all nodes, launch it with the same SCAN_LIST_PATH on any
+number of nodes: SCAN_LIST_PATH is split into units of WORK_UNIT_SIZE scans that the launched scripts
+claim in turn, and units of crashed scripts are taken over once their leases expire
 """
 
 import os
@@ -10,6 +13,7 @@ import scipy.io as sio
 import wsrlib
 from wsrdata.download_radar_scans import download_by_scan_list
 from wsrdata.render_npy_arrays import render_by_scan_list
+from wsrdata.utils.work_queue import WorkQueue, run_worker
 from wsrdata.utils.bbox_utils import scale_XYWH_box
 
 ############### Step 1: define metadata ###############
@@ -40,6 +44,10 @@ SKIP_RENDERING      = False # default False; whether to skip all rendering
 FORCE_RENDERING     = True # default False; whether to rerender even if an array npz already exists
 
 SCAN_LIST_PATH      = "prepare_dataset_v0.1.0_help/test_2.txt"
+WORK_QUEUE_DIR      = None # default None; a shared directory, e.g. f"../static/work_queues/{DATASET_VERSION}", to
+                           # split SCAN_LIST_PATH into units claimed by scripts launched on several nodes
+WORK_UNIT_SIZE      = 200 # scans per unit of the work queue
+WORK_LEASE_MINUTES  = 30 # a unit whose script stops renewing its lease for this long is claimed by another
 # SCAN_LIST_PATH      = os.path.join("../static/scan_lists", DATASET_VERSION, SPLIT_VERSION, "val.txt")
 SPLIT_PATHS         = {"train": os.path.join("../static/scan_lists", DATASET_VERSION, SPLIT_VERSION, "train.txt"),
                        "val": os.path.join("../static/scan_lists", DATASET_VERSION, SPLIT_VERSION, "val.txt"),
@@ -173,22 +181,35 @@ else:
 if not os.path.exists(ARRAY_DIR): os.mkdir(ARRAY_DIR)
 
 
-############### Step 4: Download radar scans ###############
-if not SKIP_DOWNLOADING:
-    print("Downloading scans...")
-    download_errors = download_by_scan_list(
-        SCAN_LIST_PATH, SCAN_DIR,
-        os.path.join(SCAN_LOG_DIR, f"{DATASET_VERSION}.log"),
-        os.path.join(SCAN_LOG_NOT_S3_DIR, f"{DATASET_VERSION}.log"),
-        os.path.join(SCAN_LOG_ERROR_SCANS_DIR, f"{DATASET_VERSION}.log")
-    )
-
-
-############### Step 5: Render arrays from radar scans ###############
-if not SKIP_RENDERING:
-    print("Rendering arrays...")
-    array_errors, dualpol_errors = render_by_scan_list(
-        SCAN_LIST_PATH, SCAN_DIR, ARRAY_DIR,
-        ARRAY_RENDER_CONFIG, DUALPOL_RENDER_CONFIG, FORCE_RENDERING
-    )
+def download_and_render(scan_list_path):
+    ############### Step 4: Download radar scans ###############
+    download_errors = None
+    if not SKIP_DOWNLOADING:
+        print("Downloading scans...")
+        download_errors = download_by_scan_list(
+            scan_list_path, SCAN_DIR,
+            os.path.join(SCAN_LOG_DIR, f"{DATASET_VERSION}.log"),
+            os.path.join(SCAN_LOG_NOT_S3_DIR, f"{DATASET_VERSION}.log"),
+            os.path.join(SCAN_LOG_ERROR_SCANS_DIR, f"{DATASET_VERSION}.log")
+        )
+
+    ############### Step 5: Render arrays from radar scans ###############
+    array_errors, dualpol_errors = None, None
+    if not SKIP_RENDERING:
+        print("Rendering arrays...")
+        array_errors, dualpol_errors = render_by_scan_list(
+            scan_list_path, SCAN_DIR, ARRAY_DIR,
+            ARRAY_RENDER_CONFIG, DUALPOL_RENDER_CONFIG, FORCE_RENDERING
+        )
+    return {"download_errors": download_errors, "array_errors": array_errors, "dualpol_errors": dualpol_errors}
+
+
+if WORK_QUEUE_DIR:
+    work_queue = WorkQueue(WORK_QUEUE_DIR, lease_seconds=WORK_LEASE_MINUTES * 60)
+    n_units = work_queue.add_scans([scan.strip() for scan in open(SCAN_LIST_PATH, "r").readlines() if scan.strip()],
+                                   WORK_UNIT_SIZE)
+    units = run_worker(work_queue, lambda unit, scan_list_path: download_and_render(scan_list_path))
+    print(f"Processed {len(units)} of {n_units} units; queue status: {work_queue.status()}")
+else:
+    download_and_render(SCAN_LIST_PATH)
 
@@ -29,6 +29,9 @@ import scipy.io as sio
 import wsrlib
 from wsrdata.download_radar_scans import download_by_scan_list
 from wsrdata.render_npy_arrays import render_by_scan_list
+from wsrdata.stream_radar_scans import download_and_render_by_scan_list
+from wsrdata.utils.array_io import storage_params
+from wsrdata.utils.render_manifest import RenderManifest
 from wsrdata.utils.bbox_utils import scale_XYWH_box
 
 ############### Step 1: define metadata ###############
@@ -67,6 +70,10 @@ OVERWRITE_SPLITS    = False # default False; whether to overwrite the previous j
 SKIP_DOWNLOADING    = True # default True; whether to skip all downloading
 SKIP_RENDERING      = True # default True; whether to skip all rendering
 FORCE_RENDERING     = False # default False; whether to rerender even if an array npz already exists
+USE_RENDER_MANIFEST = False # default False; whether to track rendering in ARRAY_DIR/render_manifest.sqlite, which
+                            # renders only missing or stale products and records per-scan status and errors
+STREAM_SCANS        = False # default False; whether to render scans straight from memory as they are downloaded,
+                            # without saving raw scans; only applies when neither downloading nor rendering is skipped
 
 SCAN_LIST_PATH      = os.path.join("../static/scan_lists", DATASET_VERSION, "scan_list.txt")
 SPLIT_PATHS         = {"train": os.path.join("../static/scan_lists", DATASET_VERSION, INPUT_SPLIT_VERSION, "train.txt"),
@@ -106,6 +113,15 @@ DUALPOL_RENDER_CONFIG   = {"ydirection":          ARRAY_Y_DIRECTION,
                            "elevs":               DUALPOL_ELEVATIONS,
                            "use_ground_range":    True,
                            "interp_method":       "nearest"}
+ARRAY_BACKEND           = "npz" # default "npz"; "npy" saves uncompressed per-product files that readers can
+                               # memory-map to load single channels, see wsrdata.utils.array_io.ArrayReader
+ARRAY_CODEC             = "zlib" # default "zlib"; "none", or "zstd", "lz4", "blosc" if their packages are installed,
+                                 # for npz arrays; compare with tools/benchmark_codecs.py
+ARRAY_STORAGE_DTYPE     = None # default None saves arrays as rendered (float64); "float16", or "uint8"/"uint16"
+                               # with per-field scale/offset (see wsrdata.utils.array_io), shrink arrays 2-4x
+ARRAY_PYRAMID           = [] # default []; factors to also save arrays downsampled by in the same pass, e.g. [2, 4]
+                             # adds array_300, array_150, dualpol_array_300, ... (see wsrdata.utils.array_pyramid);
+                             # to downsample an existing array version, use derive_array_version.py
 
 # in most cases, no need to change the following
 SCAN_ROOT_DIR               = "../static/scans"
@@ -117,6 +133,9 @@ ARRAY_DIR                   = os.path.join(os.getcwd(), "../static/arrays", ARRA
 ARRAY_DIMENSION_ORDER       = ["field", "elevation", "y", "x"]
 ARRAY_SHAPE                 = (len(ARRAY_ATTRIBUTES), len(ARRAY_ELEVATIONS), ARRAY_DIM, ARRAY_DIM)
 DUALPOL_SHAPE               = (len(DUALPOL_ATTRIBUTES), len(DUALPOL_ELEVATIONS), DUALPOL_DIM, DUALPOL_DIM)
+ARRAY_STORAGE               = {"array": storage_params(ARRAY_ATTRIBUTES, ARRAY_STORAGE_DTYPE),
+                               "dualpol_array": storage_params(DUALPOL_ATTRIBUTES, ARRAY_STORAGE_DTYPE)} \
+                              if ARRAY_STORAGE_DTYPE else None
 ANNOTATION_DIR              = os.path.join("../static/annotations", ANNOTATION_VERSION) if ANNOTATION_VERSION else ""
 BBOX_MODE                   = "XYWH"
 DATASET_DIR                 = f"../datasets/roosts_{DATASET_VERSION}"
@@ -175,11 +194,20 @@ if not SKIP_DOWNLOADING or not SKIP_RENDERING:
             assert v in previous_versions
     # make sure there is no config conflict
     # otherwise, either choose a new ARRAY_VERSION or clean the existing/previous version
+    array_version_config = {"array": ARRAY_RENDER_CONFIG, "dualpol": DUALPOL_RENDER_CONFIG}
+    if ARRAY_STORAGE:
+        array_version_config["storage"] = ARRAY_STORAGE
+    if ARRAY_BACKEND != "npz":
+        array_version_config["backend"] = ARRAY_BACKEND
+    if ARRAY_CODEC != "zlib":
+        array_version_config["codec"] = ARRAY_CODEC
+    if ARRAY_PYRAMID:
+        array_version_config["pyramid"] = ARRAY_PYRAMID
     if ARRAY_VERSION in previous_versions:
-        assert previous_versions[ARRAY_VERSION] == {"array": ARRAY_RENDER_CONFIG, "dualpol": DUALPOL_RENDER_CONFIG}
+        assert previous_versions[ARRAY_VERSION] == array_version_config
     # initiate ARRAY_VERSION as a new version
     else:
-        previous_versions[ARRAY_VERSION] = {"array": ARRAY_RENDER_CONFIG, "dualpol": DUALPOL_RENDER_CONFIG}
+        previous_versions[ARRAY_VERSION] = array_version_config
         with open("../static/arrays/previous_versions.json", "w") as f:
             json.dump(previous_versions, f, indent=PRETTY_PRINT_INDENT)
     if not os.path.exists(ARRAY_DIR): os.mkdir(ARRAY_DIR)
@@ -206,6 +234,10 @@ info = {
     "dualpol_shape":            DUALPOL_SHAPE,
     "dualpol_fields":           DUALPOL_ATTRIBUTES,
     "dualpol_elevations":       DUALPOL_ELEVATIONS,
+    "array_storage":            ARRAY_STORAGE, # None if arrays are saved as rendered
+    "array_backend":            ARRAY_BACKEND,
+    "array_codec":              ARRAY_CODEC,
+    "array_pyramid":            ARRAY_PYRAMID,
     "bbox_mode":                BBOX_MODE,
 }
 
@@ -225,7 +257,18 @@ for pre_dataset_version, pre_dataset_json_paths in PRE_DATASET_VERSION.items():
 
 
 ############### Step 4: Download radar scans ###############
-if not SKIP_DOWNLOADING:
+STREAMING = STREAM_SCANS and not SKIP_DOWNLOADING and not SKIP_RENDERING # Steps 4 and 5 in one pass
+if STREAMING:
+    print("Downloading and rendering scans...")
+    stream_errors = download_and_render_by_scan_list(
+        SCAN_LIST_PATH, ARRAY_DIR,
+        ARRAY_RENDER_CONFIG, DUALPOL_RENDER_CONFIG, FORCE_RENDERING,
+        storage=ARRAY_STORAGE, backend=ARRAY_BACKEND, codec=ARRAY_CODEC, pyramid=ARRAY_PYRAMID,
+        not_s3_log_path=os.path.join(SCAN_LOG_NOT_S3_DIR, f"{DATASET_VERSION}.log"),
+        error_scans_log_path=os.path.join(SCAN_LOG_ERROR_SCANS_DIR, f"{DATASET_VERSION}.log")
+    )
+    array_errors, dualpol_errors = stream_errors["array_errors"], stream_errors["dualpol_errors"]
+elif not SKIP_DOWNLOADING:
     print("Downloading scans...")
     download_errors = download_by_scan_list(
         SCAN_LIST_PATH, SCAN_DIR,
@@ -236,11 +279,13 @@ if not SKIP_DOWNLOADING:
 
 
 ############### Step 5: Render arrays from radar scans ###############
-if not SKIP_RENDERING:
+if not SKIP_RENDERING and not STREAMING:
     print("Rendering arrays...")
     array_errors, dualpol_errors = render_by_scan_list(
         SCAN_LIST_PATH, SCAN_DIR, ARRAY_DIR,
-        ARRAY_RENDER_CONFIG, DUALPOL_RENDER_CONFIG, FORCE_RENDERING
+        ARRAY_RENDER_CONFIG, DUALPOL_RENDER_CONFIG, FORCE_RENDERING,
+        storage=ARRAY_STORAGE, backend=ARRAY_BACKEND, codec=ARRAY_CODEC, pyramid=ARRAY_PYRAMID,
+        manifest=RenderManifest(os.path.join(ARRAY_DIR, "render_manifest.sqlite")) if USE_RENDER_MANIFEST else None
     )
 
 
@@ -375,7 +420,9 @@ if not os.path.exists(f"{DATASET_DIR}/roosts_{DATASET_VERSION}.json") or OVERWRI
             "dataset_version":      DATASET_VERSION,
             "key":                  key,
             "minutes_from_sunrise": minutes_from_sunrise_dict[key] if key in minutes_from_sunrise_dict else None,
-            "array_path":           f"{key[4:8]}/{key[8:10]}/{key[10:12]}/{key[0:4]}/{key}.npz",
+            "array_path":           f"{key[4:8]}/{key[8:10]}/{key[10:12]}/{key[0:4]}/{key}.npz"
+                                    if ARRAY_BACKEND == "npz" else # npy: {array_path}.{product}.npy
+                                    f"{key[4:8]}/{key[8:10]}/{key[10:12]}/{key[0:4]}/{key}",
         })
 
         if key in annotation_dict:
@@ -1,15 +1,32 @@
+from wsrdata.utils.retry_utils import AdaptiveLimiter, RetryStats, call_with_retry, classify_error
 from wsrdata.utils.s3_utils import download_scans
-from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
 import logging
+import threading
 import time
 
 
+def scan_to_aws_key(scan):
+    # KOKX20130721_093320_V06.gz -> 2013/07/21/KOKX/KOKX20130721_093320_V06.gz
+    station = scan[0:4]
+    year = scan[4:8]
+    month = scan[8:10]
+    date = scan[10:12]
+    return '%s/%s/%s/%s/%s' % (year, month, date, station, scan)
+
+
 # inputs a txt file where each line is a scan name, e.g.
 # KOKX20130721_093320_V06
 # KTBW20031123_115217
 def download_by_scan_list(filepath, out_dir, log_path,
                           not_s3_log_path, # scans that are not found in s3
-                          error_scans_log_path):
+                          error_scans_log_path,
+                          workers=1, # max concurrent downloads; lowered adaptively while s3 throttles
+                          max_in_flight=None, # max scans submitted but not yet finished, default 2 * workers
+                          s3_bucket=None, # s3 Bucket or a local stand-in, default noaa-nexrad-level2
+                          scan_cache=None, # optional ScanCache rooted at out_dir that enforces a disk budget
+                          retry_policy=None, # RetryPolicy for throttled and transient errors, default RetryPolicy()
+                          missing_cache=None): # optional MissingScanCache of scans known to be missing from s3
 
     logger = logging.getLogger(__name__)
     if not logger.handlers:
@@ -27,30 +44,60 @@ def download_by_scan_list(filepath, out_dir, log_path,
     scans = [scan.strip() for scan in open(filepath, "r").readlines()] # Load all scans
     not_s3 = [] # record scans not in s3
     error_scans = [] # record scans whose downloading fails due to reasons other than not in s3
+    stats = {"scans": 0, "bytes": 0} # successfully processed scans and newly downloaded bytes
+    lock = threading.Lock() # guards not_s3, error_scans and stats across download threads
+    retry_stats = RetryStats()
+    limiter = AdaptiveLimiter(workers) if workers > 1 else None
 
-    # download each scan
-    for scan in scans:
+    def download(scan):
         try:
             scan = '%s.gz' % scan
-            station = scan[0:4]
-            year = scan[4:8]
-            month = scan[8:10]
-            date = scan[10:12]
-            aws_key = '%s/%s/%s/%s/%s' % (year, month, date, station, scan)
+            aws_key = scan_to_aws_key(scan)
             print(aws_key)
-            download_scans([aws_key], out_dir)
+            if missing_cache is not None and scan in missing_cache:
+                logger.error('Error Scan %s known to be missing from s3, adding to list' % scan)
+                with lock:
+                    not_s3.append(scan)
+                return
+            nbytes = call_with_retry(
+                lambda: download_scans([aws_key], out_dir, s3_bucket=s3_bucket, scan_cache=scan_cache),
+                retry_policy, limiter, retry_stats
+            )
+            with lock:
+                stats["scans"] += 1
+                stats["bytes"] += nbytes
             logger.info('Downloaded scan %s, aws key %s' % (scan, aws_key))
-        except ClientError as err:
-            error_code = int(err.response['Error']['Code'])
-            if error_code == 404:
+        except Exception as ex:
+            if classify_error(ex) == 'not_found':
                 logger.error('Error Scan %s not found in s3, adding to list' % scan)
-                not_s3.append(scan)
+                with lock:
+                    not_s3.append(scan)
+                if missing_cache is not None:
+                    missing_cache.add(scan)
             else:
-                logger.error('Exception while processing scan %s - %s' % (scan, str(err)))
-                error_scans.append(scan)
-        except Exception as ex:
-            logger.error('Exception while processing scan %s - %s' % (scan, str(ex)))
-            error_scans.append(scan)
+                logger.error('Exception while processing scan %s - %s' % (scan, str(ex)))
+                with lock:
+                    error_scans.append(scan)
+
+    # download each scan
+    start = time.time()
+    if workers <= 1:
+        for scan in scans:
+            download(scan)
+    else:
+        # bound the number of submitted but unfinished scans so that huge lists are not queued up front
+        in_flight = threading.BoundedSemaphore(max_in_flight or 2 * workers)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for scan in scans:
+                in_flight.acquire()
+                future = executor.submit(download, scan)
+                future.add_done_callback(lambda _: in_flight.release())
+
+        # keep the logged lists in scan list order regardless of completion order
+        order = {'%s.gz' % scan: i for i, scan in enumerate(scans)}
+        not_s3.sort(key=order.get)
+        error_scans.sort(key=order.get)
+    elapsed = time.time() - start
 
     if len(not_s3) > 0:
         with open(not_s3_log_path, 'a+') as f:
@@ -60,5 +107,15 @@ def download_by_scan_list(filepath, out_dir, log_path,
         with open(error_scans_log_path, 'a+') as f:
             f.write('\n'.join(error_scans)+'\n')
 
+    stats["seconds"] = elapsed
+    stats["scans_per_s"] = stats["scans"] / elapsed if elapsed > 0 else 0.
+    stats["mb_per_s"] = stats["bytes"] / 1e6 / elapsed if elapsed > 0 else 0.
+    stats["retries"] = retry_stats.retries
+    stats["throttles"] = retry_stats.throttles
+    if limiter is not None:
+        stats["final_concurrency"] = int(limiter.limit)
+    logger.info('Downloaded %d scans (%.1f MB) in %.1f s with %d worker(s): %.2f scans/s, %.2f MB/s' % (
+        stats["scans"], stats["bytes"] / 1e6, elapsed, max(workers, 1), stats["scans_per_s"], stats["mb_per_s"]))
+    logger.info('Retried %d times, throttled %d times' % (stats["retries"], stats["throttles"]))
     logger.info('***** Finished downloading for file %s *****' % (filepath))
-    return {"not_s3": not_s3, "error_scans": error_scans}
\ No newline at end of file
+    return {"not_s3": not_s3, "error_scans": error_scans, "stats": stats}
@@ -0,0 +1,134 @@
+from wsrdata.download_radar_scans import scan_to_aws_key
+from wsrdata.render_npy_arrays import read_scan, with_renderer, _radar2mat
+from wsrdata.utils.array_io import ArrayReader
+from wsrdata.utils.s3_utils import fetch_scan
+import collections
+import os
+import threading
+import numpy as np
+
+
+class LazyArrays:
+    """Channels of any scan on demand, without rendering a dataset up front
+
+    get_array returns the requested channels of a scan from the arrays rendered under array_dir
+    if they are all there, and otherwise renders just those channels from the raw scan in
+    scan_dir (or, with fetch, from s3). Channels are memoized in memory with least-recently-used
+    eviction once they exceed max_bytes. As npz products are inflated whole, all their channels
+    are memoized once one is read.
+
+    Args:
+        render_config (dict): radar2mat config for channels rendered on demand, e.g. ARRAY_RENDER_CONFIG
+            or previous_versions.json[ARRAY_VERSION]["array"]; its fields and elevs are ignored.
+            Can also be a function returning the config, called when a channel is first rendered
+        array_dir (string): optional array version directory rendered with the same config
+        scan_dir (string): optional root of raw scans, e.g. static/scans/scans
+        max_bytes (int): memory budget of memoized channels
+        fetch (bool): fetch scans that are not in scan_dir from s3, into memory only
+        s3_bucket: s3 Bucket or a local stand-in, default noaa-nexrad-level2
+        index_cache (PolarIndexCache): optional, for nearest-neighbour Cartesian rendering; then array_dir
+            must have been rendered with it too, see wsrdata.render_npy_arrays.with_renderer
+        products (dict): optional fields and elevs of the products in array_dir, as in ArrayReader
+    """
+
+    def __init__(self, render_config, array_dir=None, scan_dir=None, max_bytes=1 << 30, fetch=False,
+                 s3_bucket=None, index_cache=None, products=None):
+        self.render_config = render_config
+        self.reader = ArrayReader(array_dir, products) if array_dir else None
+        self.scan_dir = scan_dir
+        self.max_bytes = max_bytes
+        self.fetch = fetch
+        self.s3_bucket = s3_bucket
+        self.index_cache = index_cache
+        self.channels = collections.OrderedDict() # (scan, field, elev) -> (y, x) image
+        self.nbytes = 0
+        self.lock = threading.Lock()
+        self.stats = {"memo": 0, "array_dir": 0, "rendered": 0} # channels served from each source
+
+    def get_array(self, scan, fields, elevs):
+        """Array of shape (len(fields), len(elevs), dim, dim) for a scan, e.g. KOKX20130721_093320_V06"""
+        keys = [(scan, field, round(float(elev), 2)) for field in fields for elev in elevs]
+        channels = {}
+        with self.lock:
+            for key in keys:
+                if key in self.channels:
+                    self.channels.move_to_end(key)
+                    channels[key] = self.channels[key]
+            self.stats["memo"] += len(channels)
+
+        missing = [key for key in keys if key not in channels]
+        if missing:
+            missing_fields = list(dict.fromkeys(field for _, field, _ in missing))
+            missing_elevs = sorted({elev for _, _, elev in missing})
+            new = self._read(scan, missing_fields, missing_elevs)
+            source = "array_dir"
+            if new is None:
+                new = self._render(scan, missing_fields, missing_elevs)
+                source = "rendered"
+            with self.lock:
+                self.stats[source] += len(missing)
+                for key, image in new.items():
+                    self._memoize(key, image)
+            channels.update(new)
+
+        return np.stack([channels[key] for key in keys]).reshape((len(fields), len(elevs)) + channels[keys[0]].shape)
+
+    def _memoize(self, key, image):
+        if key in self.channels:
+            self.nbytes -= self.channels.pop(key).nbytes
+        self.channels[key] = image
+        self.nbytes += image.nbytes
+        while self.nbytes > self.max_bytes and len(self.channels) > 1:
+            _, evicted = self.channels.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+
+    def _read(self, scan, fields, elevs):
+        # all channels of fields x elevs from array_dir, or None if any is missing
+        if self.reader is None:
+            return None
+        located = {}
+        for field in fields:
+            for elev in elevs:
+                for product, info in self.reader.products.items():
+                    product_elevs = [round(float(e), 2) for e in info["elevs"]]
+                    if field in info["fields"] and elev in product_elevs:
+                        located[(scan, field, elev)] = (product, info["fields"].index(field), product_elevs.index(elev))
+                        break
+                else:
+                    return None
+        products = {product for product, _, _ in located.values()}
+        if not all(self.reader.exists(scan, product) for product in products):
+            return None
+
+        if self.reader.backend == "npy": # memory-mapped, so only the channels are read
+            channels = {key: self.reader.read(scan, product, (i, j)) for key, (product, i, j) in located.items()}
+        else:
+            arrays = {product: self.reader.read(scan, product) for product in products}
+            channels = {}
+            for product, data in arrays.items():
+                info = self.reader.products[product]
+                for i, field in enumerate(info["fields"]):
+                    for j, elev in enumerate(info["elevs"]):
+                        channels[(scan, field, round(float(elev), 2))] = data[i, j].copy()
+        return channels
+
+    def _render(self, scan, fields, elevs):
+        scan_file = None
+        if self.scan_dir is not None:
+            scan_file = os.path.join(self.scan_dir, scan_to_aws_key(scan + ".gz"))
+        if scan_file is None or not os.path.isfile(scan_file):
+            if not self.fetch:
+                raise FileNotFoundError(f"no arrays or raw scan for {scan}")
+            scan_file = fetch_scan(scan_to_aws_key(scan + ".gz"), self.s3_bucket)
+
+        if callable(self.render_config):
+            self.render_config = self.render_config()
+        config = with_renderer(dict(self.render_config, fields=fields, elevs=elevs), self.index_cache)
+        name = config.get("renderer", "radar2mat")
+        if self.reader is not None and any(info.get("renderer", "radar2mat") != name
+                                           for info in self.reader.products.values()):
+            raise ValueError(f"arrays in {self.reader.array_dir} are not rendered by {name}; "
+                             f"their channels would not match those rendered on demand")
+        radar = read_scan(scan_file, fields) # only the fields; picking sweeps would parse the file twice
+        data = _radar2mat(radar, config, self.index_cache)[0]
+        return {(scan, field, elev): data[i, j].copy() for i, field in enumerate(fields) for j, elev in enumerate(elevs)}
@@ -1,16 +1,411 @@
 from wsrlib import pyart, radar2mat
+from wsrdata.utils.array_io import load_scan, save_scan, scan_bytes, scan_exists, write_store_info
+from wsrdata.utils.array_pyramid import pyramid_configs, pyramid_products, pyramid_storage
+from wsrdata.utils.index_cache import radar2mat_nearest
+from wsrdata.utils.profiling import RenderProfiler, profile_scan, scan_memory, stage
+from wsrdata.utils.render_manifest import is_current, missing_channels, render_settings
+from concurrent.futures import ThreadPoolExecutor
+import collections
+import gzip
+import io
 import logging
+import logging.handlers
+import multiprocessing
 import time
 import os
 import numpy as np
 
 
+# Level II moment of each pyart field, see pyart.io.nexrad_archive
+LEVEL2_MOMENTS = {"reflectivity": "REF", "velocity": "VEL", "spectrum_width": "SW",
+                  "differential_reflectivity": "ZDR", "differential_phase": "PHI",
+                  "cross_correlation_ratio": "RHO", "clutter_filter_power_removed": "CFP"}
+
+
+def select_sweeps(nfile, fields, elevs):
+    """Indices of the sweeps of a NEXRADLevel2File that rendering fields at elevs can use
+
+    For each field and elevation, these are the sweeps with the field's moment at the target
+    angle nearest to the elevation, including all split cuts at that angle. Returns None, for
+    all sweeps, if a field has no Level II moment.
+    """
+    if any(field not in LEVEL2_MOMENTS for field in fields):
+        return None
+    angles = nfile.get_target_angles()
+    moments = [info["moments"] for info in nfile.scan_info()]
+    sweeps = set()
+    for field in fields:
+        candidates = [sweep for sweep in range(len(moments)) if LEVEL2_MOMENTS[field] in moments[sweep]]
+        for elev in elevs:
+            if not candidates:
+                break
+            nearest = min(round(abs(angles[sweep] - elev), 2) for sweep in candidates)
+            sweeps.update(sweep for sweep in candidates if round(abs(angles[sweep] - elev), 2) == nearest)
+    return sorted(sweeps)
+
+
+def read_scan(scan_file, fields=None, elevs=None):
+    """Read a Level II scan from a file path or from the raw (possibly gzipped) bytes of a scan file
+
+    If fields is given, only those fields are decoded. If elevs is also given, only the sweeps
+    selected by select_sweeps are, but finding them takes a NEXRADLevel2File pass that decompresses
+    and parses the whole file before read_nexrad_archive does so again.
+    """
+    if isinstance(scan_file, bytes):
+        if scan_file[:2] == b'\x1f\x8b':
+            scan_file = gzip.decompress(scan_file)
+    elif fields is not None: # read the file once for both passes
+        scan_file = read_scan_bytes(scan_file)
+    if fields is None:
+        return pyart.io.read_nexrad_archive(io.BytesIO(scan_file) if isinstance(scan_file, bytes) else scan_file)
+
+    scans = None
+    if elevs is not None:
+        scans = select_sweeps(pyart.io.nexrad_level2.NEXRADLevel2File(io.BytesIO(scan_file)), fields, elevs)
+    return pyart.io.read_nexrad_archive(io.BytesIO(scan_file), include_fields=list(fields), scans=scans)
+
+
+def read_scan_bytes(scan_file):
+    """Raw bytes of a scan file, decompressed if gzipped, for read_scan"""
+    with open(scan_file, 'rb') as f:
+        data = f.read()
+    if data[:2] == b'\x1f\x8b':
+        data = gzip.decompress(data)
+    return data
+
+
+# log names of the products saved in each npz file
+PRODUCT_NAMES = {"array": "npy array", "dualpol_array": "dualpol npy array"}
+
+
+def renderer(config, index_cache=None):
+    """Name of the function that renders config: radar2mat_nearest for Cartesian nearest-neighbour
+    configs if an index_cache is given, radar2mat otherwise"""
+    if index_cache is not None and config.get("coords", "polar") == "cartesian" and \
+            config.get("interp_method", "nearest") == "nearest" and config.get("sweeps") is None:
+        return "radar2mat_nearest"
+    return "radar2mat"
+
+
+def with_renderer(config, index_cache=None):
+    """config with its renderer under "renderer" unless it is radar2mat
+
+    The renderers differ at ray and gate boundaries, so the renderer is part of the settings
+    recorded in RenderManifest and array_store.json; configs without it are rendered by radar2mat.
+    """
+    name = config.get("renderer") or renderer(config, index_cache)
+    return config if name == "radar2mat" else dict(config, renderer=name)
+
+
+def _radar2mat(radar, config, index_cache=None):
+    config = dict(config)
+    if (config.pop("renderer", None) or renderer(config, index_cache)) == "radar2mat_nearest":
+        if index_cache is None:
+            raise ValueError("config is rendered by radar2mat_nearest, which needs an index_cache")
+        return radar2mat_nearest(radar, index_cache, **config)
+    return radar2mat(radar, **config)
+
+
+def _shape(config):
+    return (len(config["fields"]), len(config["elevs"]), config["dim"], config["dim"])
+
+
+def _read_selection(configs):
+    # fields and elevations to read for rendering configs; elevations are None, for all sweeps,
+    # if a config selects sweeps by index
+    fields = list(dict.fromkeys(field for config in configs for field in config["fields"]))
+    if any(config.get("sweeps") is not None for config in configs):
+        return fields, None
+    return fields, sorted({float(elev) for config in configs for elev in config["elevs"]})
+
+
+def render_product(radar, scan, product, render_config, logger, arrays, index_cache=None, errors=None):
+    """Render one product of a loaded scan into arrays[product]
+
+    If errors is a dict, the exception of a failed product is stored in errors[product].
+
+    Returns:
+        bool: whether the product was rendered successfully
+    """
+    try:
+        with stage("render_" + product):
+            data, _, _, y, x = _radar2mat(radar, render_config, index_cache)
+        logger.info('Rendered a %s from scan %s' % (PRODUCT_NAMES[product], scan))
+        if data.shape != _shape(render_config):
+            logger.info(f"  Unexpectedly, its shape is {data.shape}.")
+        arrays[product] = data
+        return True
+    except Exception as ex:
+        logger.error('Exception while rendering a %s from scan %s - %s' % (PRODUCT_NAMES[product], scan, str(ex)))
+        if errors is not None:
+            errors[product] = ex
+        return False
+
+
+def render_missing(radar, scan, product, render_config, entry, arrays, logger, index_cache=None, errors=None):
+    """Bring arrays[product] up to date with render_config, rendering only the channels it lacks
+
+    Fields not in the manifest entry describing arrays[product] are rendered at every elevation
+    and new elevations are rendered for the recorded fields; existing channels are copied over in
+    the order of render_config and channels it does not have are dropped. radar is not used if
+    there is nothing to render.
+
+    Returns:
+        bool: whether the product was completed; on failure arrays[product] is left unchanged
+    """
+    new_fields, new_elevs = missing_channels(entry, render_config)
+    fields = list(render_config["fields"])
+    elevs = [round(float(elev), 2) for elev in render_config["elevs"]]
+    old_fields = list(entry[0])
+    old_elevs = [round(float(elev), 2) for elev in entry[1]]
+    old = arrays[product]
+
+    data = np.full(_shape(render_config), np.nan, dtype=old.dtype)
+    for i, field in enumerate(fields):
+        for j, elev in enumerate(elevs):
+            if field in old_fields and elev in old_elevs:
+                data[i, j] = old[old_fields.index(field), old_elevs.index(elev)]
+
+    kept_fields = [field for field in fields if field not in new_fields]
+    try:
+        with stage("update_" + product):
+            if new_fields:
+                config = dict(render_config, fields=new_fields)
+                part = _radar2mat(radar, config, index_cache)[0]
+                if part.shape != _shape(config):
+                    raise ValueError(f"unexpected shape {part.shape}")
+                for k, field in enumerate(new_fields):
+                    data[fields.index(field)] = part[k]
+            if new_elevs and kept_fields:
+                config = dict(render_config, fields=kept_fields, elevs=new_elevs)
+                part = _radar2mat(radar, config, index_cache)[0]
+                if part.shape != _shape(config):
+                    raise ValueError(f"unexpected shape {part.shape}")
+                for k, field in enumerate(kept_fields):
+                    for m, elev in enumerate(new_elevs):
+                        data[fields.index(field), elevs.index(round(float(elev), 2))] = part[k, m]
+    except Exception as ex:
+        logger.error('Exception while updating the %s of scan %s - %s' % (PRODUCT_NAMES[product], scan, str(ex)))
+        if errors is not None:
+            errors[product] = ex
+        return False
+
+    arrays[product] = data
+    logger.info('Updated the %s of scan %s with fields %s and elevations %s'
+                % (PRODUCT_NAMES[product], scan, new_fields, new_elevs))
+    return True
+
+
+def render_radar(radar, scan, array_render_config, dualpol_render_config, logger, arrays, index_cache=None,
+                 errors=None):
+    """Render the array and dualpol_array products of a loaded scan into the dict arrays
+
+    If index_cache (a PolarIndexCache) is given, Cartesian nearest-neighbour configs are rendered by
+    gathering through cached index maps instead of calling radar2mat.
+
+    Returns:
+        (bool, bool): whether the array and the dualpol array were rendered successfully
+    """
+    # The two products usually differ only in fields. Then one radar2mat call over the union of fields
+    # selects sweeps and interpolates once; it requires all fields so that the result splits by position.
+    n_array_fields = len(array_render_config["fields"])
+    combined_fields = list(array_render_config["fields"]) + list(dualpol_render_config["fields"])
+    if dict(array_render_config, fields=None) == dict(dualpol_render_config, fields=None) and \
+            all(field in radar.fields for field in combined_fields):
+        try:
+            with stage("render_combined"):
+                data, _, _, y, x = _radar2mat(radar, dict(array_render_config, fields=combined_fields), index_cache)
+            if data.shape == (len(combined_fields),) + _shape(array_render_config)[1:]:
+                arrays["array"] = data[:n_array_fields]
+                logger.info('Rendered a npy array from scan %s' % scan)
+                arrays["dualpol_array"] = data[n_array_fields:]
+                logger.info('Rendered a dualpol npy array from scan %s' % scan)
+                return True, True
+        except Exception as ex:
+            logger.info('  Rendering all fields at once failed for scan %s - %s' % (scan, str(ex)))
+
+    array_ok = render_product(radar, scan, "array", array_render_config, logger, arrays, index_cache, errors)
+    dualpol_ok = render_product(radar, scan, "dualpol_array", dualpol_render_config, logger, arrays, index_cache,
+                                errors)
+    return array_ok, dualpol_ok
+
+
+def render_scan(scan, scan_dir, array_dir, array_render_config, dualpol_render_config, force_rendering, logger,
+                index_cache=None, manifest_entries=None, storage=None, backend="npz", errors=None, codec="zlib",
+                read=None, save=save_scan, selective_read=False, pyramid=()):
+    """Render and save the arrays of one scan, e.g. KOKX20130721_093320_V06
+
+    With manifest_entries, a dict of RenderManifest entries (or None) per product, rendering is
+    incremental: products whose entry has the fields and elevations of their config, in order, are
+    kept, products rendered with the same settings get only their missing fields and elevations
+    and are rearranged in the order of their config, and other products are rendered from scratch.
+    The scan is not read if products only need rearranging. Products saved before the manifest existed are taken as current if their
+    shape matches the config and it is rendered by radar2mat.
+
+    Arrays are saved with save_scan in the given backend and codec, quantized according to storage if given.
+    If errors is a dict, exceptions are stored in it under "load" or the name of the failed product.
+    If read is given, it is called for the bytes of the scan file instead of reading the file, and
+    save, called with the arguments of save_scan, can replace save_scan.
+    With selective_read, only the fields and sweeps needed by the products to render are decoded;
+    finding the sweeps parses the scan file twice, so it is off by default.
+    For each factor in pyramid, products downsampled by it are saved too, e.g. array_300 for factor 2
+    and a 600 x 600 array; storage should include them, see wsrdata.utils.array_pyramid.pyramid_storage.
+
+    Returns:
+        (bool, bool): whether the array and the dualpol array are available after rendering;
+            both are True if the scan is skipped because its arrays already exist
+    """
+    station = scan[0:4]
+    year = scan[4:8]
+    month = scan[8:10]
+    date = scan[10:12]
+    scan_file = os.path.join(scan_dir, f"{year}/{month}/{date}/{station}/{scan}.gz")
+    arrays = {}
+
+    array_render_config = with_renderer(array_render_config, index_cache)
+    dualpol_render_config = with_renderer(dualpol_render_config, index_cache)
+    if manifest_entries is not None:
+        with stage("load_arrays"):
+            arrays = load_scan(array_dir, scan, storage, backend)
+        configs = {"array": array_render_config, "dualpol_array": dualpol_render_config}
+        entries = {}
+        for product, config in configs.items():
+            entry = manifest_entries.get(product)
+            if product not in arrays:
+                entry = None
+            elif entry is None and "renderer" not in config and arrays[product].shape == _shape(config):
+                entry = (list(config["fields"]), list(config["elevs"]), render_settings(config))
+            entries[product] = entry
+        missing = {product: missing_channels(entries[product], config) for product, config in configs.items()}
+        if all(is_current(entries[product], config) for product, config in configs.items()):
+            logger.info('Rendered arrays already exist for scan %s' % scan)
+            return True, True
+    elif scan_exists(array_dir, scan, backend):
+        if force_rendering:
+            with stage("load_arrays"): # products that fail to re-render keep their previous arrays
+                arrays = load_scan(array_dir, scan, storage, backend)
+        else:
+            logger.info('Rendered arrays already exist for scan %s' % scan)
+            return True, True
+
+    radar = None
+    if manifest_entries is None or any(channels != ([], []) for channels in missing.values()):
+        try:
+            with stage("read_scan"):
+                selection = (None, None)
+                if selective_read:
+                    if manifest_entries is None:
+                        selection = _read_selection([array_render_config, dualpol_render_config])
+                    else:
+                        selection = _read_selection([config for product, config in configs.items()
+                                                     if missing[product] != ([], [])])
+                radar = read_scan(read() if read is not None else scan_file, *selection)
+            logger.info('Loaded scan %s' % scan)
+        except Exception as ex:
+            logger.error('Exception while loading scan %s - %s' % (scan, str(ex)))
+            if errors is not None:
+                errors["load"] = ex
+            return False, False
+
+    if manifest_entries is None or all(channels is None for channels in missing.values()):
+        array_ok, dualpol_ok = render_radar(radar, scan, array_render_config, dualpol_render_config,
+                                            logger, arrays, index_cache, errors)
+    else:
+        ok = {}
+        for product, config in configs.items():
+            if is_current(entries[product], config):
+                ok[product] = True
+            elif missing[product] is None:
+                ok[product] = render_product(radar, scan, product, config, logger, arrays, index_cache, errors)
+            else:
+                ok[product] = render_missing(radar, scan, product, config, entries[product], arrays,
+                                             logger, index_cache, errors)
+        array_ok, dualpol_ok = ok["array"], ok["dualpol_array"]
+
+    if len(arrays) > 0:
+        if pyramid:
+            with stage("pyramid"):
+                arrays.update(pyramid_products(arrays, pyramid))
+        with stage("save"):
+            save(array_dir, scan, arrays, storage, backend, codec)
+
+    return array_ok, dualpol_ok
+
+
+# state of each process of the rendering pool, set by _init_render_worker
+_worker = {}
+
+
+def _init_render_worker(log_queue, filepath, scan_dir, array_dir,
+                        array_render_config, dualpol_render_config, force_rendering, index_cache, storage, backend,
+                        profile, cprofile_every, cprofile_dir, codec, selective_read, pyramid):
+    # workers hand their log records to the parent process, which writes them to rendering.log
+    logger = logging.getLogger(__name__ + ".worker")
+    logger.handlers = [logging.handlers.QueueHandler(log_queue)]
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    _worker.update(scan_dir=scan_dir, array_dir=array_dir,
+                   array_render_config=array_render_config, dualpol_render_config=dualpol_render_config,
+                   force_rendering=force_rendering, logger=logging.LoggerAdapter(logger, {"fname": filepath}),
+                   index_cache=index_cache, storage=storage, backend=backend,
+                   profile=profile, cprofile_every=cprofile_every, cprofile_dir=cprofile_dir, codec=codec,
+                   selective_read=selective_read, pyramid=pyramid)
+
+
+# number of scans rendered by this process, to pick those run under cProfile
+_jobs = {"count": 0}
+
+
+def _render_job(scan, manifest_entries, profile=False, cprofile_every=0, cprofile_dir=None, **kwargs):
+    # render_scan with its timing and errors, as strings that can be sent between processes;
+    # with profile, also its stage timings and memory, see wsrdata.utils.profiling.scan_memory
+    start = time.time()
+    errors = {}
+    stages = None
+    if profile:
+        _jobs["count"] += 1
+        cprofile_path = None
+        if cprofile_every and cprofile_dir and (_jobs["count"] - 1) % cprofile_every == 0:
+            cprofile_path = os.path.join(cprofile_dir, f"{scan}.prof")
+        with scan_memory() as memory, profile_scan(cprofile_path) as stages:
+            array_ok, dualpol_ok = render_scan(scan, manifest_entries=manifest_entries, errors=errors, **kwargs)
+        stages["memory"] = memory
+    else:
+        array_ok, dualpol_ok = render_scan(scan, manifest_entries=manifest_entries, errors=errors, **kwargs)
+    errors = {name: (type(ex).__name__, str(ex)) for name, ex in errors.items()}
+    return array_ok, dualpol_ok, time.time() - start, errors, stages
+
+
+def _render_scan_in_worker(task):
+    scan, manifest_entries = task
+    return scan, _render_job(scan, manifest_entries, **_worker)
+
+
 # inputs a txt file where each line is a scan name, e.g.
 # KOKX20130721_093320_V06
 # KTBW20031123_115217
 def render_by_scan_list(filepath, scan_dir, array_dir,
                         array_render_config, dualpol_render_config,
-                        force_rendering=False):
+                        force_rendering=False,
+                        scan_cache=None, # optional ScanCache rooted at scan_dir, see wsrdata.utils.scan_cache
+                        workers=1, # number of rendering processes; 1 renders in the calling process
+                        chunksize=4, # scans handed to a worker process at a time
+                        index_cache=None, # optional PolarIndexCache for nearest-neighbour Cartesian rendering
+                        manifest=None, # optional RenderManifest; renders only missing or stale products, fields and elevations
+                        storage=None, # optional storage_params per product, e.g. {"array": storage_params(fields, "uint8")}
+                        backend="npz", # "npz" or "npy", see wsrdata.utils.array_io
+                        max_attempts=3, # with a manifest, scans that failed this many times in a row are not rendered again
+                        progress_every=1000, # scans between progress reports in rendering.log
+                        profile_path=None, # optional JSON lines file of per-scan stage timings and a final summary
+                        cprofile_every=0, # with profile_path, dump cProfile stats of every n-th scan of each process
+                        codec="zlib", # compression of npz files, see wsrdata.utils.array_io.get_codec
+                        io_threads=0, # with workers=1, threads saving arrays while later scans render and
+                                      # one reading scans ahead; 0 reads, renders and saves each scan in turn
+                        prefetch=2, # scans read ahead of rendering when io_threads > 0
+                        selective_read=False, # decode only the fields and sweeps used by the render configs; picking
+                                              # the sweeps parses each file twice, so compare with profile_path first
+                        pyramid=()): # factors to also save downsampled products by, e.g. (2, 4) for array_300 and
+                                     # array_150 next to a 600 x 600 array, see wsrdata.utils.array_pyramid
 
     log_path = os.path.join(array_dir, "rendering.log")
         # this includes successful rendering for arrays and dualpol arrays
@@ -25,65 +420,144 @@ def render_by_scan_list(filepath, scan_dir, array_dir,
         filelog.setFormatter(formatter)
         logger.setLevel(logging.DEBUG)
         logger.addHandler(filelog)
+    handlers = logger.handlers
     logger = logging.LoggerAdapter(logger, {"fname": filepath})
 
     logger.info('***** Start rendering for %s *****' % (filepath))
+    array_render_config = with_renderer(array_render_config, index_cache)
+    dualpol_render_config = with_renderer(dualpol_render_config, index_cache)
+    configs = {"array": array_render_config, "dualpol_array": dualpol_render_config}
+    storage = pyramid_storage(storage, configs, pyramid)
+    write_store_info(array_dir, backend, storage, dict(configs, **pyramid_configs(configs, pyramid)), codec)
 
     scans = [scan.strip() for scan in open(filepath, "r").readlines()] # Load all scans
     array_errors = [] # to record scans from which array rendering fails
     dualpol_errors = [] # to record scans from which dualpol array rendering fails
 
-    # render arrays from scans
-    for scan in scans:
-        station = scan[0:4]
-        year = scan[4:8]
-        month = scan[8:10]
-        date = scan[10:12]
-        scan_file = os.path.join(scan_dir, f"{year}/{month}/{date}/{station}/{scan}.gz")
-        arrays = {}
-        npz_path = os.path.join(array_dir, f"{year}/{month}/{date}/{station}/{scan}.npz")
-
-        if os.path.exists(npz_path):
-            if force_rendering:
-                arrays = np.load(npz_path)
-            else:
-                logger.info('Rendered arrays already exist for scan %s' % scan)
-                continue
+    progress = {"rendered": 0, "failed": 0, "start": time.time()}
+    profiler = RenderProfiler(profile_path) if profile_path else None
+    cprofile_dir = os.path.splitext(profile_path)[0] + "_cprofile" if profile_path and cprofile_every else None
 
-        try:
-            radar = pyart.io.read_nexrad_archive(scan_file)
-            logger.info('Loaded scan %s' % scan)
-        except Exception as ex:
-            logger.error('Exception while loading scan %s - %s' % (scan, str(ex)))
+    def record(scan, array_ok, dualpol_ok, seconds=None, errors=None, stages=None, rendered=True):
+        if not array_ok:
             array_errors.append(scan)
+        if not dualpol_ok:
             dualpol_errors.append(scan)
+        if scan_cache is not None:
+            scan_key = f"{scan[4:8]}/{scan[8:10]}/{scan[10:12]}/{scan[0:4]}/{scan}.gz"
+            scan_cache.touch(scan_key)
+            if array_ok:
+                scan_cache.mark_rendered(scan_key)
+        if manifest is not None and rendered:
+            if array_ok:
+                manifest.put(scan, "array", array_render_config)
+            if dualpol_ok:
+                manifest.put(scan, "dualpol_array", dualpol_render_config)
+            manifest.finish_job(scan, array_ok, dualpol_ok, seconds, scan_bytes(array_dir, scan, backend), errors)
+        if profiler is not None and stages is not None:
+            memory = stages.pop("memory")
+            profiler.add(scan, seconds, stages, memory)
+        if rendered:
+            progress["rendered"] += 1
+            progress["failed"] += not (array_ok and dualpol_ok)
+            if progress["rendered"] % progress_every == 0 or progress["rendered"] == len(tasks):
+                logger.info('Progress: rendered %d of %d scans, %d with errors, %.2f scans/s'
+                            % (progress["rendered"], len(tasks), progress["failed"],
+                               progress["rendered"] / max(time.time() - progress["start"], 1e-9)))
+
+    # with a manifest, scans whose products are all current are skipped without opening their npz
+    tasks = []
+    for scan in scans:
+        if manifest is None or force_rendering:
+            tasks.append((scan, None))
             continue
+        entries = {"array": manifest.get(scan, "array"), "dualpol_array": manifest.get(scan, "dualpol_array")}
+        job = manifest.get_job(scan)
+        if is_current(entries["array"], array_render_config) and \
+                is_current(entries["dualpol_array"], dualpol_render_config):
+            logger.info('Rendered arrays already exist for scan %s' % scan)
+            record(scan, True, True, rendered=False)
+        elif job is not None and job["status"] == "failed" and job["attempts"] >= max_attempts:
+            logger.info('Skipping scan %s which failed %d times in a row - %s' % (scan, job["attempts"], job["error"]))
+            record(scan, job["array_ok"], job["dualpol_ok"], rendered=False)
+        else:
+            tasks.append((scan, entries))
+    if manifest is not None:
+        manifest.start_jobs([scan for scan, _ in tasks])
 
-        try:
-            data, _, _, y, x = radar2mat(radar, **array_render_config)
-            logger.info('Rendered a npy array from scan %s' % scan)
-            if data.shape != (len(array_render_config["fields"]), len(array_render_config["elevs"]),
-                              array_render_config["dim"], array_render_config["dim"]):
-                logger.info(f"  Unexpectedly, its shape is {data.shape}.")
-            arrays["array"] = data
-        except Exception as ex:
-            logger.error('Exception while rendering a npy array from scan %s - %s' % (scan, str(ex)))
-            array_errors.append(scan)
+    # render arrays from scans
+    render_kwargs = dict(scan_dir=scan_dir, array_dir=array_dir, array_render_config=array_render_config,
+                         dualpol_render_config=dualpol_render_config, force_rendering=force_rendering,
+                         logger=logger, index_cache=index_cache, storage=storage, backend=backend,
+                         profile=profiler is not None, cprofile_every=cprofile_every, cprofile_dir=cprofile_dir,
+                         codec=codec, selective_read=selective_read, pyramid=pyramid)
+    if workers <= 1 and io_threads <= 0:
+        for scan, entries in tasks:
+            record(scan, *_render_job(scan, entries, **render_kwargs))
+    elif workers <= 1:
+        # A reader thread reads and decompresses the next scans and writer threads compress and save
+        # rendered arrays while this thread renders. At most prefetch scans are read ahead and
+        # io_threads scans wait to be saved. Scans are recorded in order once their arrays are saved.
+        with ThreadPoolExecutor(1) as reader, ThreadPoolExecutor(io_threads) as writer:
+            def read_ahead(scan, entries):
+                if entries is None and not force_rendering and scan_exists(array_dir, scan, backend):
+                    return scan, entries, None # skipped by render_scan without reading
+                scan_file = os.path.join(scan_dir, f"{scan[4:8]}/{scan[8:10]}/{scan[10:12]}/{scan[0:4]}/{scan}.gz")
+                return scan, entries, reader.submit(read_scan_bytes, scan_file).result
 
-        try:
-            data, _, _, y, x = radar2mat(radar, **dualpol_render_config)
-            logger.info('Rendered a dualpol npy array from scan %s' % scan)
-            if data.shape != (len(dualpol_render_config["fields"]), len(dualpol_render_config["elevs"]),
-                              dualpol_render_config["dim"], dualpol_render_config["dim"]):
-                logger.info(f"  Unexpectedly, its shape is {data.shape}.")
-            arrays["dualpol_array"] = data
-        except Exception as ex:
-            logger.error('Exception while rendering a dualpol npy array from scan %s - %s' % (scan, str(ex)))
-            dualpol_errors.append(scan)
+            def finish(scan, status, saved):
+                for future in saved:
+                    future.result() # errors of saving are raised as in serial rendering
+                record(scan, *status)
+
+            pending = iter(tasks)
+            reads = collections.deque(read_ahead(scan, entries) for scan, entries in
+                                      (task for _, task in zip(range(max(prefetch, 1)), pending)))
+            saves = collections.deque()
+            while reads:
+                scan, entries, read = reads.popleft()
+                for task in pending:
+                    reads.append(read_ahead(*task))
+                    break
+                saved = []
+                status = _render_job(scan, entries, read=read,
+                                     save=lambda *args: saved.append(writer.submit(save_scan, *args)),
+                                     **render_kwargs)
+                saves.append((scan, status, saved))
+                while saves and (len(saves) > io_threads or all(future.done() for future in saves[0][2])):
+                    finish(*saves.popleft())
+            while saves:
+                finish(*saves.popleft())
+    else:
+        # scans are handed out in chunks as workers become free; a single listener writes all log records
+        with multiprocessing.Manager() as manager:
+            log_queue = manager.Queue()
+            listener = logging.handlers.QueueListener(log_queue, *handlers)
+            listener.start()
+            try:
+                with multiprocessing.Pool(workers, _init_render_worker,
+                                          (log_queue, filepath, scan_dir, array_dir,
+                                           array_render_config, dualpol_render_config, force_rendering,
+                                           index_cache, storage, backend,
+                                           profiler is not None, cprofile_every, cprofile_dir, codec,
+                                           selective_read, pyramid)) as pool:
+                    for scan, status in pool.imap_unordered(_render_scan_in_worker, tasks, chunksize=chunksize):
+                        record(scan, *status)
+            finally:
+                listener.stop()
+        # record errors in scan list order as in serial rendering
+        order = {scan: i for i, scan in enumerate(scans)}
+        array_errors.sort(key=order.get)
+        dualpol_errors.sort(key=order.get)
+
+    if profiler is not None:
+        summary = profiler.close()
+        for name, timing in summary.items():
+            logger.info('Profile: %s p50 %.3fs p90 %.3fs p99 %.3fs max %.3fs over %d scans'
+                        % (name, timing["p50"], timing["p90"], timing["p99"], timing["max"], timing["count"]))
 
-        if len(arrays) > 0:
-            os.makedirs(os.path.join(array_dir, f"{year}/{month}/{date}/{station}"), exist_ok=True)
-            np.savez_compressed(npz_path, **arrays)
+    if scan_cache is not None:
+        scan_cache.evict()
 
     if len(array_errors) > 0:
         with open(array_error_log_path, 'a+') as f:
@@ -93,4 +567,4 @@ def render_by_scan_list(filepath, scan_dir, array_dir,
             f.write('\n'.join(dualpol_errors)+'\n')
 
     logger.info('***** Finished rendering for file %s *****' % (filepath))
-    return array_errors, dualpol_errors
\ No newline at end of file
+    return array_errors, dualpol_errors
@@ -0,0 +1,194 @@
+from wsrdata.download_radar_scans import scan_to_aws_key
+from wsrdata.render_npy_arrays import read_scan, render_radar, _read_selection
+from wsrdata.utils.array_io import load_scan, save_scan, scan_exists, write_store_info
+from wsrdata.utils.array_pyramid import pyramid_configs, pyramid_products, pyramid_storage
+from wsrdata.utils.retry_utils import AdaptiveLimiter, RetryStats, call_with_retry, classify_error
+from wsrdata.utils.s3_utils import fetch_scan, mkdir_p
+import logging
+import os
+import queue
+import threading
+import time
+
+
+# inputs a txt file where each line is a scan name, e.g.
+# KOKX20130721_093320_V06
+# KTBW20031123_115217
+def download_and_render_by_scan_list(filepath, array_dir,
+                                     array_render_config, dualpol_render_config,
+                                     force_rendering=False,
+                                     scan_dir=None, # if given, raw scans are reused from and saved to this directory
+                                     workers=4, # number of threads fetching scans
+                                     queue_size=8, # max fetched scans held in memory waiting for rendering
+                                     s3_bucket=None, # s3 Bucket or a local stand-in, default noaa-nexrad-level2
+                                     storage=None, # optional storage_params per product, as in render_by_scan_list
+                                     backend="npz", # "npz" or "npy", as in render_by_scan_list
+                                     codec="zlib", # compression of npz files, as in render_by_scan_list
+                                     selective_read=False, # decode only the fields and sweeps used, as in render_by_scan_list
+                                     pyramid=(), # factors of downsampled products, as in render_by_scan_list
+                                     not_s3_log_path=None, # appended with scans not found in s3, as in download_by_scan_list
+                                     error_scans_log_path=None, # appended with scans that failed to download
+                                     retry_policy=None, # RetryPolicy for throttled and transient errors, default RetryPolicy()
+                                     missing_cache=None): # optional MissingScanCache of scans known to be missing from s3
+    """Download scans into memory and render them as they arrive, without a pass over raw files on disk
+
+    Fetching threads overlap network I/O with rendering in the calling thread; a bounded
+    queue limits how many raw scans are held in memory. Fetches are retried and their
+    concurrency adapted to throttling as in download_by_scan_list, whose not_s3 and error
+    scan logs are written in the same format. Rendering logs go to array_dir as in
+    render_by_scan_list.
+
+    Returns:
+        dict: scans not in s3, scans that failed to download, scans whose array or dualpol
+            array failed (which include scans that could not be downloaded), and retry stats
+    """
+
+    log_path = os.path.join(array_dir, "rendering.log")
+    array_error_log_path = os.path.join(array_dir, "array_error_scans.log")
+    dualpol_error_log_path = os.path.join(array_dir, "dualpol_error_scans.log")
+
+    logger = logging.getLogger(__name__)
+    if not logger.handlers:
+        filelog = logging.FileHandler(log_path)
+        formatter = logging.Formatter('%(asctime)s [ %(fname)s ] : %(message)s')
+        formatter.converter = time.gmtime
+        filelog.setFormatter(formatter)
+        logger.setLevel(logging.DEBUG)
+        logger.addHandler(filelog)
+    logger = logging.LoggerAdapter(logger, {"fname": filepath})
+
+    logger.info('***** Start downloading and rendering for %s *****' % (filepath))
+    configs = {"array": array_render_config, "dualpol_array": dualpol_render_config}
+    storage = pyramid_storage(storage, configs, pyramid)
+    write_store_info(array_dir, backend, storage, dict(configs, **pyramid_configs(configs, pyramid)), codec)
+
+    scans = [scan.strip() for scan in open(filepath, "r").readlines()] # Load all scans
+    not_s3 = [] # record scans not in s3
+    error_scans = [] # record scans whose downloading fails due to reasons other than not in s3
+    array_errors = [] # to record scans from which array rendering fails
+    dualpol_errors = [] # to record scans from which dualpol array rendering fails
+    lock = threading.Lock() # guards not_s3 and error_scans across fetching threads
+    retry_stats = RetryStats()
+    limiter = AdaptiveLimiter(workers) if workers > 1 else None
+
+    selection = (None, None)
+    if selective_read:
+        selection = _read_selection([array_render_config, dualpol_render_config])
+
+    # only fetch scans that need rendering
+    scan_queue = queue.Queue()
+    for scan in scans:
+        if scan_exists(array_dir, scan, backend) and not force_rendering:
+            logger.info('Rendered arrays already exist for scan %s' % scan)
+            continue
+        scan_queue.put(scan)
+    for _ in range(workers):
+        scan_queue.put(None) # one stop signal per fetching thread
+
+    fetched = queue.Queue(maxsize=queue_size)
+
+    def fetch_one(scan):
+        # raw bytes of a scan, or None if it is missing from s3 or could not be downloaded
+        aws_key = scan_to_aws_key('%s.gz' % scan)
+        if missing_cache is not None and '%s.gz' % scan in missing_cache:
+            logger.error('Error Scan %s.gz known to be missing from s3, adding to list' % scan)
+            with lock:
+                not_s3.append(scan)
+            return None
+        local_file = os.path.join(scan_dir, aws_key) if scan_dir else None
+        try:
+            if local_file and os.path.isfile(local_file):
+                with open(local_file, 'rb') as f:
+                    return f.read()
+            data = call_with_retry(lambda: fetch_scan(aws_key, s3_bucket), retry_policy, limiter, retry_stats)
+            if local_file:
+                mkdir_p(os.path.dirname(local_file))
+                with open(local_file + '.part', 'wb') as f:
+                    f.write(data)
+                os.replace(local_file + '.part', local_file)
+            return data
+        except Exception as ex:
+            if classify_error(ex) == 'not_found':
+                logger.error('Error Scan %s not found in s3, adding to list' % scan)
+                with lock:
+                    not_s3.append(scan)
+                if missing_cache is not None:
+                    missing_cache.add('%s.gz' % scan)
+            else:
+                logger.error('Exception while downloading scan %s - %s' % (scan, str(ex)))
+                with lock:
+                    error_scans.append(scan)
+            return None
+
+    def fetch():
+        while True:
+            scan = scan_queue.get()
+            if scan is None:
+                fetched.put(None)
+                return
+            fetched.put((scan, fetch_one(scan)))
+
+    for _ in range(workers):
+        threading.Thread(target=fetch, daemon=True).start()
+
+    # render scans in the order they arrive
+    running = workers
+    while running > 0:
+        item = fetched.get()
+        if item is None:
+            running -= 1
+            continue
+        scan, data = item
+
+        if data is None: # logged by fetch_one
+            array_errors.append(scan)
+            dualpol_errors.append(scan)
+            continue
+
+        arrays = load_scan(array_dir, scan, storage, backend)
+
+        try:
+            radar = read_scan(data, *selection)
+            logger.info('Loaded scan %s' % scan)
+        except Exception as ex:
+            logger.error('Exception while loading scan %s - %s' % (scan, str(ex)))
+            array_errors.append(scan)
+            dualpol_errors.append(scan)
+            continue
+        del data
+
+        array_ok, dualpol_ok = render_radar(radar, scan, array_render_config, dualpol_render_config,
+                                            logger, arrays)
+        if not array_ok:
+            array_errors.append(scan)
+        if not dualpol_ok:
+            dualpol_errors.append(scan)
+
+        if len(arrays) > 0:
+            arrays.update(pyramid_products(arrays, pyramid))
+            save_scan(array_dir, scan, arrays, storage, backend, codec)
+
+    # keep the logged lists in scan list order regardless of arrival order
+    order = {scan: i for i, scan in enumerate(scans)}
+    for errors in [not_s3, error_scans, array_errors, dualpol_errors]:
+        errors.sort(key=order.get)
+
+    # the download logs list scan files, as written by download_by_scan_list
+    if not_s3_log_path and len(not_s3) > 0:
+        with open(not_s3_log_path, 'a+') as f:
+            f.write('\n'.join('%s.gz' % scan for scan in not_s3)+'\n')
+    if error_scans_log_path and len(error_scans) > 0:
+        with open(error_scans_log_path, 'a+') as f:
+            f.write('\n'.join('%s.gz' % scan for scan in error_scans)+'\n')
+    if len(array_errors) > 0:
+        with open(array_error_log_path, 'a+') as f:
+            f.write('\n'.join(array_errors)+'\n')
+    if len(dualpol_errors) > 0:
+        with open(dualpol_error_log_path, 'a+') as f:
+            f.write('\n'.join(dualpol_errors)+'\n')
+
+    logger.info('Retried %d times, throttled %d times' % (retry_stats.retries, retry_stats.throttles))
+    logger.info('***** Finished downloading and rendering for file %s *****' % (filepath))
+    return {"not_s3": not_s3, "error_scans": error_scans,
+            "array_errors": array_errors, "dualpol_errors": dualpol_errors,
+            "stats": {"retries": retry_stats.retries, "throttles": retry_stats.throttles}}
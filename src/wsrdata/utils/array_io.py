@@ -0,0 +1,418 @@
+import io
+import json
+import os
+import socket
+import time
+import numpy as np
+
+
+# value ranges over which rendered fields are quantized to integers; values outside are clipped
+FIELD_RANGES = {
+    "reflectivity":                 (-32., 95.),   # dBZ
+    "velocity":                     (-64., 64.),   # m/s
+    "spectrum_width":               (0., 64.),     # m/s
+    "differential_reflectivity":    (-8., 8.),     # dB
+    "cross_correlation_ratio":      (0., 1.1),
+    "differential_phase":           (0., 360.),    # degrees
+}
+
+STORAGE_DTYPES = ("float16", "uint8", "uint16")
+
+# npz: one compressed file per scan, KOKX20130721_093320_V06.npz
+# npy: one uncompressed file per product, KOKX20130721_093320_V06.array.npy, readable with mmap_mode
+ARRAY_BACKENDS = ("npz", "npy")
+PRODUCTS = ("array", "dualpol_array")
+STORE_INFO = "array_store.json" # backend, storage, codec and products of an array directory
+METADATA_SUFFIXES = ("_scale", "_offset", "_nan", "_codec") # npz entries saved alongside products
+
+
+def _zstd_codec():
+    import zstandard
+    return (lambda raw, itemsize: zstandard.ZstdCompressor(level=3).compress(raw),
+            lambda data, itemsize: zstandard.ZstdDecompressor().decompress(data))
+
+
+def _lz4_codec():
+    import lz4.frame
+    return (lambda raw, itemsize: lz4.frame.compress(raw),
+            lambda data, itemsize: lz4.frame.decompress(data))
+
+
+def _blosc_codec():
+    import blosc
+    return (lambda raw, itemsize: blosc.compress(raw, typesize=itemsize, cname="zstd", clevel=5,
+                                                 shuffle=blosc.SHUFFLE),
+            lambda data, itemsize: blosc.decompress(data))
+
+
+# Codecs for the products in npz files. "zlib" writes with np.savez_compressed and "none" with
+# np.savez, both readable by plain np.load. Other codecs store each product as encoded bytes in an
+# uncompressed npz next to a <product>_codec entry describing it; they are created on first use
+# from optional packages (zstandard, lz4, blosc) and more can be added with register_codec.
+CODECS = {"zlib": None, "none": None}
+_CODEC_FACTORIES = {"zstd": _zstd_codec, "lz4": _lz4_codec, "blosc": _blosc_codec}
+
+
+def register_codec(name, encode, decode):
+    """Add a codec; encode(raw_bytes, itemsize) and decode(encoded_bytes, itemsize) return bytes"""
+    CODECS[name] = (encode, decode)
+
+
+def get_codec(name):
+    """(encode, decode) of a codec, or None for "zlib" and "none"
+
+    Raises:
+        ImportError: if the package providing the codec is not installed
+    """
+    if name not in CODECS:
+        if name not in _CODEC_FACTORIES:
+            raise ValueError(f"unknown codec {name}; available: {sorted(set(CODECS) | set(_CODEC_FACTORIES))}")
+        try:
+            CODECS[name] = _CODEC_FACTORIES[name]()
+        except ImportError as ex:
+            raise ImportError(f"codec {name} requires a package that is not installed - {ex}")
+    return CODECS[name]
+
+
+def storage_params(fields, dtype, field_ranges=None):
+    """Storage settings of a product whose first dimension is fields
+
+    With an integer dtype, a value x of field i is stored as round((x - offset[i]) / scale[i]),
+    using all levels but the largest, which is the sentinel for NaN (no data). The result is
+    json-serializable so that it can be recorded in dataset info.
+
+    Args:
+        fields (list): field names, e.g. ARRAY_RENDER_CONFIG["fields"]
+        dtype (string): one of STORAGE_DTYPES
+        field_ranges (dict): (min, max) per field overriding FIELD_RANGES
+    """
+    assert dtype in STORAGE_DTYPES, f"storage dtype must be one of {STORAGE_DTYPES}"
+    if dtype == "float16":
+        return {"dtype": dtype}
+
+    ranges = dict(FIELD_RANGES, **(field_ranges or {}))
+    sentinel = int(np.iinfo(dtype).max)
+    scale, offset = [], []
+    for field in fields:
+        low, high = ranges[field]
+        scale.append((high - low) / (sentinel - 1))
+        offset.append(low)
+    return {"dtype": dtype, "fields": list(fields), "scale": scale, "offset": offset, "nan": sentinel}
+
+
+def quantize(data, params):
+    """Convert a float product of shape (fields, ...) to its storage dtype"""
+    if params["dtype"] == "float16":
+        return data.astype(np.float16)
+    if data.shape[0] != len(params["scale"]):
+        raise ValueError(f"storage params for {len(params['scale'])} fields do not fit an array of shape {data.shape}")
+    shape = (-1,) + (1,) * (data.ndim - 1)
+    scale = np.asarray(params["scale"], dtype=np.float64).reshape(shape)
+    offset = np.asarray(params["offset"], dtype=np.float64).reshape(shape)
+    levels = np.clip(np.rint((data - offset) / scale), 0, params["nan"] - 1)
+    return np.where(np.isnan(data), params["nan"], levels).astype(params["dtype"])
+
+
+def dequantize(data, params, field_index=slice(None)):
+    """Convert a stored product back to float32, with NaN where there is no data
+
+    Args:
+        field_index: fields of the product that data holds, e.g. 0 if data is product[0, 0]
+    """
+    if params["dtype"] == "float16":
+        return data.astype(np.float32)
+    scale = np.asarray(params["scale"], dtype=np.float32)[field_index]
+    offset = np.asarray(params["offset"], dtype=np.float32)[field_index]
+    if scale.ndim:
+        scale = scale.reshape((-1,) + (1,) * (data.ndim - 1))
+        offset = offset.reshape((-1,) + (1,) * (data.ndim - 1))
+    values = np.asarray(data * scale + offset, dtype=np.float32)
+    values[data == params["nan"]] = np.nan
+    return values
+
+
+def save_arrays(npz_path, arrays, storage=None, codec="zlib"):
+    """Save products to an npz file, compressed with codec
+
+    Args:
+        arrays (dict): float products, e.g. {"array": ..., "dualpol_array": ...}
+        storage (dict): optional storage_params per product; products without an entry are saved
+            as rendered. The scale, offset and sentinel of quantized products are saved alongside
+            them as <product>_scale, <product>_offset and <product>_nan.
+        codec (string): one of CODECS, see get_codec
+
+    npz_path can also be a writable file object, e.g. io.BytesIO. A path is written under
+    another name and then renamed, so that readers and a worker that resumes an interrupted
+    render never see a partially written file.
+    """
+    storage = storage or {}
+    coder = get_codec(codec)
+    saved = {}
+    for product, data in arrays.items():
+        params = storage.get(product)
+        if params is not None:
+            data = quantize(data, params)
+            if params["dtype"] != "float16":
+                saved[f"{product}_scale"] = np.asarray(params["scale"], dtype=np.float64)
+                saved[f"{product}_offset"] = np.asarray(params["offset"], dtype=np.float64)
+                saved[f"{product}_nan"] = np.asarray(params["nan"])
+        if coder is None:
+            saved[product] = data
+            continue
+        data = np.ascontiguousarray(data)
+        saved[product] = np.frombuffer(coder[0](data.tobytes(), data.itemsize), dtype=np.uint8)
+        saved[f"{product}_codec"] = np.asarray(json.dumps({"codec": codec, "dtype": data.dtype.str,
+                                                           "shape": list(data.shape)}))
+    save = np.savez_compressed if codec == "zlib" else np.savez
+    if hasattr(npz_path, "write"):
+        save(npz_path, **saved)
+        return
+    part_path = _part_path(npz_path)
+    with open(part_path, "wb") as f:
+        save(f, **saved)
+    os.replace(part_path, npz_path)
+
+
+def _part_path(path):
+    # temporary name of a file being written, unique to the process so that concurrent writers
+    # of the same file, e.g. on two nodes, do not write into each other
+    return "%s.%s.%d.part" % (path, socket.gethostname(), os.getpid())
+
+
+def _read_product(npz, product):
+    # a product as saved, decoded if it was saved with a codec other than zlib or none
+    data = npz[product]
+    if f"{product}_codec" not in npz.files:
+        return data
+    info = json.loads(npz[f"{product}_codec"].item())
+    dtype = np.dtype(info["dtype"])
+    raw = get_codec(info["codec"])[1](data.tobytes(), dtype.itemsize)
+    return np.frombuffer(bytearray(raw), dtype=dtype).reshape(info["shape"]) # writable, as from np.load
+
+
+def _to_float(data, params, field_index=slice(None)):
+    # float products as rendered are returned unchanged
+    if params is not None:
+        return dequantize(data, params, field_index)
+    if data.dtype == np.float16:
+        return data.astype(np.float32)
+    return data
+
+
+def _npz_params(npz, product, data):
+    # quantization parameters saved with a product by save_arrays, if any
+    if data.dtype == np.float16:
+        return {"dtype": "float16"}
+    if f"{product}_scale" not in npz.files:
+        return None
+    return {"dtype": data.dtype.name, "scale": npz[f"{product}_scale"],
+            "offset": npz[f"{product}_offset"], "nan": npz[f"{product}_nan"].item()}
+
+
+def load_arrays(npz_path, products=None):
+    """Load products from an npz file written by save_arrays or by earlier rendering
+
+    Quantized products are dequantized to float32 using the parameters saved with them.
+
+    Args:
+        products (list): names of the products to load; default all
+
+    Returns:
+        dict: product name -> float array
+    """
+    arrays = {}
+    with np.load(npz_path) as npz:
+        names = [name for name in npz.files if not name.endswith(METADATA_SUFFIXES)]
+        for product in products if products is not None else names:
+            if product in names:
+                data = _read_product(npz, product)
+                arrays[product] = _to_float(data, _npz_params(npz, product, data))
+    return arrays
+
+
+def benchmark_codec(codec, samples, storage=None, repeat=3):
+    """Compression ratio and save/load throughput of save_arrays and load_arrays with a codec
+
+    Args:
+        samples (list): dicts of float products, e.g. loaded from real npz files with load_arrays
+        storage (dict): optional storage_params per product, applied before compression
+
+    Returns:
+        dict: ratio (stored bytes / file bytes), encode_mb_s and decode_mb_s, in MB of stored
+            (quantized) arrays per second, best of repeat runs
+    """
+    storage = storage or {}
+    raw_bytes = sum(quantize(data, storage[product]).nbytes if storage.get(product) else data.nbytes
+                    for arrays in samples for product, data in arrays.items())
+    encode, decode, encoded_bytes = float("inf"), float("inf"), 0
+    for _ in range(repeat):
+        buffers = []
+        start = time.perf_counter()
+        for arrays in samples:
+            buffer = io.BytesIO()
+            save_arrays(buffer, arrays, storage, codec)
+            buffers.append(buffer)
+        encode = min(encode, time.perf_counter() - start)
+        encoded_bytes = sum(len(buffer.getvalue()) for buffer in buffers)
+        start = time.perf_counter()
+        for buffer in buffers:
+            buffer.seek(0)
+            load_arrays(buffer)
+        decode = min(decode, time.perf_counter() - start)
+    return {"codec": codec, "ratio": raw_bytes / encoded_bytes,
+            "encode_mb_s": raw_bytes / 1e6 / encode, "decode_mb_s": raw_bytes / 1e6 / decode}
+
+
+def scan_path(array_dir, scan, backend="npz", product="array"):
+    """Path of the file holding a product of a scan, e.g. 2013/07/21/KOKX/KOKX20130721_093320_V06.npz"""
+    station_dir = os.path.join(array_dir, f"{scan[4:8]}/{scan[8:10]}/{scan[10:12]}/{scan[0:4]}")
+    if backend == "npz":
+        return os.path.join(station_dir, f"{scan}.npz")
+    return os.path.join(station_dir, f"{scan}.{product}.npy")
+
+
+def scan_exists(array_dir, scan, backend="npz"):
+    """Whether any product of a scan has been saved"""
+    return any(os.path.exists(scan_path(array_dir, scan, backend, product)) for product in PRODUCTS)
+
+
+def scan_bytes(array_dir, scan, backend="npz"):
+    """Bytes on disk of the saved products of a scan"""
+    paths = {scan_path(array_dir, scan, backend, product) for product in PRODUCTS}
+    return sum(os.path.getsize(path) for path in paths if os.path.exists(path))
+
+
+def save_scan(array_dir, scan, arrays, storage=None, backend="npz", codec="zlib"):
+    """Save the products of a scan with save_arrays (npz) or as one .npy file per product (npy)
+
+    The npy backend does not save quantization parameters with the arrays; they are recorded
+    once for the directory by write_store_info. It does not compress, so codec only applies to npz.
+    """
+    os.makedirs(os.path.dirname(scan_path(array_dir, scan, backend)), exist_ok=True)
+    if backend == "npz":
+        save_arrays(scan_path(array_dir, scan, backend), arrays, storage, codec)
+        return
+    storage = storage or {}
+    for product, data in arrays.items():
+        path = scan_path(array_dir, scan, backend, product)
+        if storage.get(product) is not None:
+            data = quantize(data, storage[product])
+        with open(_part_path(path), "wb") as f: # readers never see a partially written file
+            np.save(f, data)
+        os.replace(_part_path(path), path)
+
+
+def load_scan(array_dir, scan, storage=None, backend="npz"):
+    """Load all saved products of a scan as float arrays
+
+    Returns:
+        dict: product name -> float array
+    """
+    if backend == "npz":
+        path = scan_path(array_dir, scan, backend)
+        return load_arrays(path) if os.path.exists(path) else {}
+    storage = storage or {}
+    arrays = {}
+    for product in PRODUCTS:
+        path = scan_path(array_dir, scan, backend, product)
+        if os.path.exists(path):
+            arrays[product] = _to_float(np.load(path), storage.get(product))
+    return arrays
+
+
+def read_store_info(array_dir):
+    """Contents of array_dir/array_store.json, or None for directories rendered before it existed"""
+    path = os.path.join(array_dir, STORE_INFO)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def write_store_info(array_dir, backend="npz", storage=None, configs=None, codec="zlib"):
+    """Record the backend, storage, codec and product fields, elevations and renderer of array_dir
+
+    The renderer of a product is that under "renderer" in its config, radar2mat if there is none.
+
+    Raises:
+        ValueError: if arrays in array_dir were saved with another backend, storage or codec,
+            or a product was rendered by another renderer
+    """
+    assert backend in ARRAY_BACKENDS, f"backend must be one of {ARRAY_BACKENDS}"
+    if backend == "npy" and codec != "zlib":
+        raise ValueError("the npy backend does not compress; codecs only apply to npz")
+    get_codec(codec) # fail before rendering if the codec is not available
+    info = read_store_info(array_dir)
+    if info is not None and (info["backend"], info["storage"], info.get("codec", "zlib")) != \
+            (backend, storage or None, codec):
+        raise ValueError(f"arrays in {array_dir} are stored with backend {info['backend']}, storage "
+                         f"{info['storage']} and codec {info.get('codec', 'zlib')}; use another array version")
+    products = dict(info["products"]) if info is not None else {}
+    for product, config in (configs or {}).items():
+        renderer = config.get("renderer", "radar2mat")
+        if product in products and products[product].get("renderer", "radar2mat") != renderer:
+            raise ValueError(f"{product} arrays in {array_dir} are rendered by "
+                             f"{products[product].get('renderer', 'radar2mat')}, not {renderer}; "
+                             f"use another array version")
+        products[product] = {"fields": list(config["fields"]), "elevs": list(config["elevs"])}
+        if renderer != "radar2mat":
+            products[product]["renderer"] = renderer
+    new_info = {"backend": backend, "storage": storage or None, "codec": codec, "products": products}
+    if info is not None and json.loads(json.dumps(new_info)) == info:
+        return
+    # replaced atomically, as renders on other processes or nodes may be reading it
+    os.makedirs(array_dir, exist_ok=True)
+    path = os.path.join(array_dir, STORE_INFO)
+    tmp_path = "%s.%s.%d.tmp" % (path, socket.gethostname(), os.getpid())
+    with open(tmp_path, "w") as f:
+        json.dump(new_info, f)
+    os.replace(tmp_path, path)
+
+
+class ArrayReader:
+    """Read rendered arrays, or parts of them, from an array version directory
+
+    Supports npz trees, including those rendered before array_store.json existed, and npy trees.
+    With the npy backend, read() memory-maps the product file so that a single channel costs
+    only its own I/O; with npz the product is inflated whole before indexing.
+
+    Args:
+        array_dir (string): e.g. static/arrays/v0.2.0
+        products (dict): optional {"array": {"fields": [...], "elevs": [...]}, ...} for channel();
+            default from array_store.json
+    """
+
+    def __init__(self, array_dir, products=None):
+        self.array_dir = array_dir
+        info = read_store_info(array_dir) or {}
+        self.backend = info.get("backend", "npz")
+        self.storage = info.get("storage") or {}
+        self.products = products or info.get("products", {})
+
+    def exists(self, scan, product="array"):
+        path = scan_path(self.array_dir, scan, self.backend, product)
+        if self.backend == "npy" or not os.path.exists(path):
+            return os.path.exists(path)
+        with np.load(path) as npz: # only reads the zip directory
+            return product in npz.files
+
+    def read(self, scan, product="array", index=()):
+        """Float values of product[index], e.g. index (0, 0) for the first field at the first elevation"""
+        if not isinstance(index, tuple):
+            index = (index,)
+        field_index = index[0] if index else slice(None)
+        path = scan_path(self.array_dir, scan, self.backend, product)
+        if self.backend == "npy":
+            data = np.array(np.load(path, mmap_mode="r")[index]) # copied out of the read-only memmap
+            return _to_float(data, self.storage.get(product), field_index)
+        with np.load(path) as npz:
+            data = _read_product(npz, product)
+            return _to_float(data[index], _npz_params(npz, product, data), field_index)
+
+    def channel(self, scan, field, elev):
+        """(y, x) image of one field at one elevation"""
+        for product, info in self.products.items():
+            if field in info["fields"]:
+                elevs = [round(float(e), 2) for e in info["elevs"]]
+                return self.read(scan, product, (info["fields"].index(field), elevs.index(round(float(elev), 2))))
+        raise KeyError(f"no product with field {field}")
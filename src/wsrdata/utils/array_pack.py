@@ -0,0 +1,182 @@
+import io
+import os
+import sqlite3
+import threading
+import numpy as np
+
+from wsrdata.utils.array_io import save_arrays, load_arrays, scan_path, _npz_params, _read_product, _to_float
+
+
+def shard_path(pack_dir, shard):
+    return os.path.join(pack_dir, "shard-%05d.pack" % shard)
+
+
+class PackWriter:
+    """Append npz records of scans to shard files under pack_dir, indexed by scan name
+
+    Each record is the bytes of the npz file that save_arrays would write for the scan, so that
+    quantized products keep their parameters. Records are appended to shard-00000.pack,
+    shard-00001.pack, ... and a new shard is started once the current one exceeds shard_bytes.
+    The offset of a record is committed to pack_index.sqlite only after the record is written,
+    so an interrupted writer leaves at most unreferenced bytes at the end of a shard. Adding a
+    scan that is already packed appends a new record and points the index to it.
+    Only one writer should use a pack directory at a time.
+
+    Args:
+        pack_dir (string): directory of the shards and their index, created if needed
+        shard_bytes (int): size after which a new shard is started
+    """
+
+    def __init__(self, pack_dir, shard_bytes=1 << 30):
+        self.pack_dir = pack_dir
+        self.shard_bytes = shard_bytes
+        self.lock = threading.Lock()
+
+        os.makedirs(pack_dir, exist_ok=True)
+        self.conn = sqlite3.connect(os.path.join(pack_dir, "pack_index.sqlite"), timeout=60, check_same_thread=False)
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS records ('
+                              'scan TEXT PRIMARY KEY, shard INTEGER, offset INTEGER, size INTEGER)')
+        shards = sorted(f for f in os.listdir(pack_dir) if f.startswith("shard-") and f.endswith(".pack"))
+        self.shard = int(shards[-1][6:11]) if shards else 0
+        self.file = open(shard_path(pack_dir, self.shard), "ab")
+
+    def __contains__(self, scan):
+        with self.lock:
+            return self.conn.execute('SELECT 1 FROM records WHERE scan = ?', (scan,)).fetchone() is not None
+
+    def add_bytes(self, scan, data):
+        """Append the bytes of an npz file as the record of scan"""
+        with self.lock:
+            if self.file.tell() > 0 and self.file.tell() + len(data) > self.shard_bytes:
+                self.file.close()
+                self.shard += 1
+                self.file = open(shard_path(self.pack_dir, self.shard), "ab")
+            offset = self.file.tell()
+            self.file.write(data)
+            self.file.flush()
+            with self.conn:
+                self.conn.execute('INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?)',
+                                  (scan, self.shard, offset, len(data)))
+
+    def add(self, scan, arrays, storage=None, codec="zlib"):
+        """Append the products of a scan, quantized and compressed as in save_arrays"""
+        buffer = io.BytesIO()
+        save_arrays(buffer, arrays, storage, codec)
+        self.add_bytes(scan, buffer.getvalue())
+
+    def close(self):
+        self.file.close()
+        self.conn.close()
+
+
+class PackReader:
+    """Random access and sequential reads of scans packed by PackWriter
+
+    read() and exists() mirror ArrayReader so that consumers can use either.
+
+    Args:
+        pack_dir (string): directory written by PackWriter
+    """
+
+    def __init__(self, pack_dir):
+        self.pack_dir = pack_dir
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(os.path.join(pack_dir, "pack_index.sqlite"), timeout=60, check_same_thread=False)
+        self.files = {} # shard -> open file descriptor
+
+    def _fd(self, shard):
+        with self.lock:
+            if shard not in self.files:
+                self.files[shard] = os.open(shard_path(self.pack_dir, shard), os.O_RDONLY)
+            return self.files[shard]
+
+    def _locate(self, scan):
+        with self.lock:
+            row = self.conn.execute('SELECT shard, offset, size FROM records WHERE scan = ?', (scan,)).fetchone()
+        if row is None:
+            raise KeyError(scan)
+        return row
+
+    def __contains__(self, scan):
+        with self.lock:
+            return self.conn.execute('SELECT 1 FROM records WHERE scan = ?', (scan,)).fetchone() is not None
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM records').fetchone()[0]
+
+    def keys(self):
+        with self.lock:
+            return [row[0] for row in self.conn.execute('SELECT scan FROM records ORDER BY shard, offset')]
+
+    def read_bytes(self, scan):
+        shard, offset, size = self._locate(scan)
+        return os.pread(self._fd(shard), size, offset)
+
+    def load(self, scan, products=None):
+        """Float products of a scan, as load_arrays"""
+        return load_arrays(io.BytesIO(self.read_bytes(scan)), products)
+
+    def exists(self, scan, product="array"):
+        if scan not in self:
+            return False
+        with np.load(io.BytesIO(self.read_bytes(scan))) as npz:
+            return product in npz.files
+
+    def read(self, scan, product="array", index=()):
+        """Float values of product[index], as ArrayReader.read"""
+        if not isinstance(index, tuple):
+            index = (index,)
+        with np.load(io.BytesIO(self.read_bytes(scan))) as npz:
+            data = _read_product(npz, product)
+            return _to_float(data[index], _npz_params(npz, product, data), index[0] if index else slice(None))
+
+    def stream(self, products=None):
+        """Yield (scan, float products) for all packed scans, reading each shard front to back"""
+        with self.lock:
+            rows = self.conn.execute('SELECT scan, shard, offset, size FROM records ORDER BY shard, offset').fetchall()
+        current, f = None, None
+        try:
+            for scan, shard, offset, size in rows:
+                if shard != current:
+                    if f is not None:
+                        f.close()
+                    current, f = shard, open(shard_path(self.pack_dir, shard), "rb", buffering=1 << 22)
+                f.seek(offset) # records replaced by later ones are skipped over
+                yield scan, load_arrays(io.BytesIO(f.read(size)), products)
+        finally:
+            if f is not None:
+                f.close()
+
+    def close(self):
+        for fd in self.files.values():
+            os.close(fd)
+        self.files = {}
+        self.conn.close()
+
+
+def pack_array_tree(array_dir, pack_dir, scans=None, shard_bytes=1 << 30):
+    """Copy the npz files of an array tree into a pack, skipping scans that are already packed
+
+    npz bytes are copied as they are, without decompressing. The tree is walked unless the
+    scans to pack are given, e.g. from a scan list.
+
+    Returns:
+        int: number of scans packed
+    """
+    if scans is None:
+        scans = sorted(f[:-4] for _, _, files in os.walk(array_dir) for f in files if f.endswith(".npz"))
+    writer = PackWriter(pack_dir, shard_bytes)
+    n = 0
+    try:
+        for scan in scans:
+            path = scan_path(array_dir, scan)
+            if scan in writer or not os.path.exists(path):
+                continue
+            with open(path, "rb") as f:
+                writer.add_bytes(scan, f.read())
+            n += 1
+    finally:
+        writer.close()
+    return n
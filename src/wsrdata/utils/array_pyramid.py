@@ -0,0 +1,100 @@
+import os
+import warnings
+import numpy as np
+
+from wsrdata.utils.array_io import PRODUCTS, load_scan, read_store_info, save_scan, scan_exists, write_store_info
+
+
+def downsample(data, factor):
+    """Average factor x factor blocks of the last two (y, x) axes, ignoring NaN
+
+    A block is NaN only if all its pixels are NaN, so sparse echoes are kept rather than
+    dropped. The last two axes must be divisible by factor.
+    """
+    if factor == 1:
+        return data
+    *lead, ny, nx = data.shape
+    if ny % factor or nx % factor:
+        raise ValueError(f"array of shape {data.shape} cannot be downsampled by {factor}")
+    blocks = data.reshape(tuple(lead) + (ny // factor, factor, nx // factor, factor))
+    with warnings.catch_warnings(): # all-NaN blocks
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        return np.nanmean(blocks, axis=(-3, -1))
+
+
+def center_crop(data, size):
+    """Central size x size pixels of the last two (y, x) axes"""
+    ny, nx = data.shape[-2:]
+    y, x = (ny - size) // 2, (nx - size) // 2
+    return data[..., y:y + size, x:x + size]
+
+
+def pyramid_name(product, dim, factor):
+    """Name of a product downsampled by factor, e.g. array_300 for array at dim 600 and factor 2"""
+    return f"{product}_{dim // factor}"
+
+
+def pyramid_products(arrays, factors):
+    """Downsampled levels of the products in arrays, each computed from the full resolution product
+
+    Returns:
+        dict: e.g. {"array_300": ..., "array_150": ...} for factors (2, 4) and a 600 x 600 array
+    """
+    levels = {}
+    for product in PRODUCTS:
+        if product in arrays:
+            dim = arrays[product].shape[-1]
+            for factor in factors:
+                levels[pyramid_name(product, dim, factor)] = downsample(arrays[product], factor)
+    return levels
+
+
+def pyramid_configs(configs, factors):
+    """Fields, elevs and dim of the pyramid levels of products rendered with configs"""
+    return {pyramid_name(product, config["dim"], factor): dict(config, dim=config["dim"] // factor)
+            for product, config in configs.items() for factor in factors}
+
+
+def pyramid_storage(storage, configs, factors):
+    """storage_params for the pyramid levels too, which share those of their full resolution product"""
+    if not storage:
+        return storage
+    levels = {pyramid_name(product, config["dim"], factor): storage[product]
+              for product, config in configs.items() for factor in factors if storage.get(product) is not None}
+    return dict(storage, **levels)
+
+
+def derive_array_tree(src_dir, dst_dir, factor=2, crop=None, scans=None, products=PRODUCTS):
+    """Write a lower resolution array version from an existing one, without the raw scans
+
+    Each product is center cropped to crop x crop pixels if crop is given, e.g. 300 of 600 pixels
+    for a window of half the range, then downsampled by factor. Arrays are saved with the
+    backend, storage and codec of src_dir. Scans already in dst_dir are skipped. Pixel centers of
+    the result are block centers of the source grid, so values approximate, but do not equal,
+    rendering at the lower resolution.
+
+    Args:
+        scans (list): scans to derive; default walks src_dir
+
+    Returns:
+        int: number of scans written
+    """
+    info = read_store_info(src_dir) or {}
+    backend, storage, codec = info.get("backend", "npz"), info.get("storage"), info.get("codec", "zlib")
+    write_store_info(dst_dir, backend, storage, {product: config for product, config in info.get("products", {}).items()
+                                                 if product in products}, codec)
+    if scans is None:
+        suffix = ".npz" if backend == "npz" else ".npy"
+        scans = sorted({f.split(".")[0] for _, _, files in os.walk(src_dir) for f in files if f.endswith(suffix)})
+
+    n = 0
+    for scan in scans:
+        if scan_exists(dst_dir, scan, backend) or not scan_exists(src_dir, scan, backend):
+            continue
+        arrays = {}
+        for product, data in load_scan(src_dir, scan, storage, backend).items():
+            if product in products:
+                arrays[product] = downsample(center_crop(data, crop) if crop else data, factor)
+        save_scan(dst_dir, scan, arrays, storage, backend, codec)
+        n += 1
+    return n
@@ -0,0 +1,179 @@
+import collections
+import hashlib
+import os
+import threading
+import numpy as np
+
+
+EARTH_RADIUS = 6371000.0 # meters
+EFFECTIVE_EARTH_RADIUS = EARTH_RADIUS * 4. / 3. # standard refraction model
+
+
+def slant2ground(r, theta):
+    """Convert slant range (m) at elevation angle theta (degrees) to ground range (m), 4/3 earth model"""
+    theta = np.deg2rad(theta)
+    h = np.sqrt(r ** 2 + EFFECTIVE_EARTH_RADIUS ** 2 + 2 * r * EFFECTIVE_EARTH_RADIUS * np.sin(theta)) \
+        - EFFECTIVE_EARTH_RADIUS
+    return EFFECTIVE_EARTH_RADIUS * np.arcsin(r * np.cos(theta) / (EFFECTIVE_EARTH_RADIUS + h))
+
+
+def cartesian_grid(r_max, dim, ydirection='xy'):
+    """Compass azimuth (degrees) and range (m) of the pixels of a dim x dim grid spanning [-r_max, r_max]
+
+    With ydirection 'xy' row 0 is South; with 'ij' row 0 is North, as in radar2mat.
+    """
+    v = np.linspace(-r_max, r_max, dim)
+    X, Y = np.meshgrid(v, v)
+    if ydirection == 'ij':
+        Y = np.flipud(Y)
+    phi = np.mod(90. - np.rad2deg(np.arctan2(Y, X)), 360.)
+    r = np.sqrt(X ** 2 + Y ** 2)
+    return phi, r, v
+
+
+class PolarIndexCache:
+    """Cache of gather indices mapping Cartesian pixels to the nearest gate of a polar sweep
+
+    With nearest-neighbour interpolation, the gate that lands on each pixel depends only on the
+    sweep geometry (azimuths, gate ranges, elevation) and the rendering config, which repeat
+    across scans of the same station and VCP. A map is keyed by a hash of that geometry, with
+    azimuths quantized to az_res / 4 so that small pointing jitter between scans still hits the
+    cache; rendering a sweep is then a single fancy-index gather. Maps are kept in memory with
+    LRU eviction and, if cache_dir is given, also saved as .npy files shared across processes.
+
+    Args:
+        max_entries (int): number of maps kept in memory
+        cache_dir (string): optional directory for maps on disk
+    """
+
+    def __init__(self, max_entries=64, cache_dir=None):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.maps = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def __getstate__(self):
+        # sent to worker processes without the lock and the maps in memory
+        return {"max_entries": self.max_entries, "cache_dir": self.cache_dir}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    @staticmethod
+    def geometry_key(azimuths, ranges, elevation, config):
+        h = hashlib.sha1()
+        h.update(np.ascontiguousarray(azimuths, dtype=np.int64).tobytes())
+        h.update(np.ascontiguousarray(ranges, dtype=np.float64).tobytes())
+        h.update(repr((round(float(elevation), 2), sorted(config.items()))).encode())
+        return h.hexdigest()
+
+    def get(self, key, build):
+        """Return the map stored under key, calling build() to create it if needed"""
+        with self.lock:
+            if key in self.maps:
+                self.maps.move_to_end(key)
+                self.hits += 1
+                return self.maps[key]
+
+        path = os.path.join(self.cache_dir, key + '.npy') if self.cache_dir else None
+        if path and os.path.exists(path):
+            index_map = np.load(path)
+        else:
+            index_map = build()
+            if path:
+                tmp_path = '%s.%d.tmp.npy' % (path[:-4], os.getpid())
+                np.save(tmp_path, index_map)
+                os.replace(tmp_path, path)
+
+        with self.lock:
+            self.misses += 1
+            self.maps[key] = index_map
+            while len(self.maps) > self.max_entries:
+                self.maps.popitem(last=False)
+        return index_map
+
+
+def build_index_map(azimuths, ranges, az_res, r_res, r_max, dim, ydirection='xy', max_interp_dist=1.0):
+    """Flat indices into a (len(azimuths), len(ranges)) sweep for each pixel, or -1 where no gate is close
+
+    Args:
+        azimuths (np.ndarray): sorted compass azimuths of rays (degrees)
+        ranges (np.ndarray): sorted (ground) ranges of gates (m)
+        az_res, r_res: nominal azimuth (degrees) and gate (m) spacing; pixels farther than
+            max_interp_dist times these from the nearest ray or gate get no data
+    """
+    phi, r, _ = cartesian_grid(r_max, dim, ydirection)
+    n_rays, n_gates = len(azimuths), len(ranges)
+
+    # nearest ray, wrapping around north
+    right = np.searchsorted(azimuths, phi) % n_rays
+    left = (right - 1) % n_rays
+    d_right = np.abs(np.mod(azimuths[right] - phi + 180., 360.) - 180.)
+    d_left = np.abs(np.mod(azimuths[left] - phi + 180., 360.) - 180.)
+    ray = np.where(d_left <= d_right, left, right)
+    d_ray = np.minimum(d_left, d_right)
+
+    # nearest gate
+    upper = np.clip(np.searchsorted(ranges, r), 1, n_gates - 1)
+    lower = upper - 1
+    gate = np.where(np.abs(ranges[lower] - r) <= np.abs(ranges[upper] - r), lower, upper)
+    d_gate = np.abs(ranges[gate] - r)
+
+    index_map = (ray * n_gates + gate).astype(np.int32)
+    index_map[(d_ray > max_interp_dist * az_res) | (d_gate > max_interp_dist * r_res)] = -1
+    return index_map
+
+
+def select_sweep(angles, counts, elev):
+    """Sweep at the fixed angle nearest to elev among sweeps with data (counts > 0); among split cuts
+    at that angle, the one with the most valid gates. Returns None if no sweep has data."""
+    candidates = [(round(abs(angle - elev), 2), -count, sweep)
+                  for sweep, (angle, count) in enumerate(zip(angles, counts)) if count > 0]
+    return min(candidates)[2] if candidates else None
+
+
+def radar2mat_nearest(radar, cache, fields, elevs, r_min=2125.0, r_max=459875.0, r_res=250, az_res=0.5,
+                      dim=600, ydirection='xy', use_ground_range=True, max_interp_dist=1.0, **kwargs):
+    """Cartesian nearest-gate rendering through cached index maps; returns data, fields, elevs, y, x
+    with data of shape (len(fields), len(elevs), dim, dim) like radar2mat(coords='cartesian').
+
+    Gates nearer than r_min are dropped. Values can differ from radar2mat's interpolator at
+    ray/gate boundaries, so arrays rendered this way should be kept in their own array version.
+    """
+    config = {"r_min": r_min, "r_max": r_max, "r_res": r_res, "az_res": az_res, "dim": dim,
+              "ydirection": ydirection, "use_ground_range": use_ground_range, "max_interp_dist": max_interp_dist}
+    v = np.linspace(-r_max, r_max, dim)
+    data = np.full((len(fields), len(elevs), dim, dim), np.nan)
+
+    angles = radar.fixed_angle['data']
+    for i, field in enumerate(fields):
+        counts = [np.ma.count(radar.get_field(sweep, field)) for sweep in range(radar.nsweeps)]
+        for j, elev in enumerate(elevs):
+            sweep = select_sweep(angles, counts, elev)
+            if sweep is None:
+                continue
+            rays = radar.get_slice(sweep)
+            angle = angles[sweep]
+            order = np.argsort(radar.azimuth['data'][rays], kind='stable')
+            quantum = az_res / 4.
+            azimuths = np.round(radar.azimuth['data'][rays][order] / quantum).astype(np.int64)
+
+            ranges = radar.range['data']
+            keep = ranges >= r_min
+            ranges = ranges[keep]
+            if use_ground_range:
+                ranges = slant2ground(ranges, angle)
+
+            key = PolarIndexCache.geometry_key(azimuths, ranges, angle, config)
+            index_map = cache.get(key, lambda: build_index_map(azimuths * quantum, ranges, az_res, r_res,
+                                                                 r_max, dim, ydirection, max_interp_dist))
+
+            values = radar.get_field(sweep, field)[order][:, keep]
+            values = np.ma.filled(values.astype(np.float64), np.nan).ravel()
+            data[i, j] = np.where(index_map >= 0, values[np.maximum(index_map, 0)], np.nan)
+
+    return data, fields, elevs, v, v
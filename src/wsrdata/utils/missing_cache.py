@@ -0,0 +1,56 @@
+import os
+import sqlite3
+import threading
+import time
+
+
+class MissingScanCache:
+    """Persistent set of names known to be missing from s3, checked before making requests
+
+    Scans are recorded by file name (e.g. KOKX20130721_093320_V06.gz, as in not_s3 logs) and
+    empty station-day listings by their s3 prefix (e.g. 2013/07/21/KOKX/KOKX). With an expiry,
+    entries older than it are treated as unknown so that they get re-checked once in a while.
+
+    Args:
+        path (string): sqlite file, created if it does not exist
+        expiry (timedelta): optional lifetime of entries; None keeps them forever
+    """
+
+    def __init__(self, path, expiry=None):
+        self.path = path
+        self.expiry = expiry.total_seconds() if expiry is not None else None
+        self.lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS missing (name TEXT PRIMARY KEY, checked_at REAL)')
+
+    def __contains__(self, name):
+        with self.lock:
+            row = self.conn.execute('SELECT checked_at FROM missing WHERE name = ?', (name,)).fetchone()
+        if row is None:
+            return False
+        return self.expiry is None or time.time() - row[0] <= self.expiry
+
+    def add(self, name):
+        self.add_many([name])
+
+    def add_many(self, names):
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO missing VALUES (?, ?)', [(name, now) for name in names])
+
+    def discard(self, name):
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM missing WHERE name = ?', (name,))
+
+    def import_log(self, log_path):
+        """Add the scans of a not_s3 log written by download_by_scan_list"""
+        with open(log_path, 'r') as f:
+            self.add_many([line.strip() for line in f if line.strip()])
+
+    def close(self):
+        self.conn.close()
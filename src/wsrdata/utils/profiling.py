@@ -0,0 +1,163 @@
+import contextlib
+import cProfile
+import json
+import os
+import threading
+import time
+import numpy as np
+
+
+# timings are collected for the scan being profiled by the current thread, if any
+_current = threading.local()
+
+# log-spaced histogram bin edges in seconds, 1 ms to 100 s
+HISTOGRAM_EDGES = [10. ** (k / 4.) for k in range(-12, 9)]
+
+
+def rss_mb():
+    """Current resident set size of this process in MB, or None where unavailable (read from /proc)"""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1048576.
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def _reset_peak_rss():
+    # reset the kernel's high-water mark of RSS for this process (Linux); False if not permitted
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_mb():
+    # VmHWM, the high-water mark of RSS since the process started or its last reset
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024. # kB
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+@contextlib.contextmanager
+def scan_memory(interval=0.005):
+    """Memory used while the block renders a scan, set in the yielded dict when it exits
+
+    The dict gets "peak_rss_mb", the peak RSS of the process during the block, "rss_mb" after the
+    block and "rss_delta_mb", its change over the block; values are None where unavailable. On
+    Linux the peak is the kernel's high-water mark, reset before the block, so it includes the
+    short-lived temporaries of decoding and interpolation. Where the reset is not permitted, a
+    thread samples the RSS every interval seconds, which can miss shorter peaks. Either way the
+    peak is that of the whole process, including other threads running meanwhile.
+    """
+    memory = {}
+    rss_before = rss_mb()
+    stop = threading.Event()
+    samples = [rss_before]
+    sampler = None
+    if not _reset_peak_rss() and rss_before is not None:
+        def sample():
+            while not stop.wait(interval):
+                samples.append(rss_mb())
+        sampler = threading.Thread(target=sample, daemon=True)
+        sampler.start()
+    try:
+        yield memory
+    finally:
+        rss_after = rss_mb()
+        if sampler is not None:
+            stop.set()
+            sampler.join()
+            peak = max(samples + [rss_after])
+        else:
+            peak = _peak_rss_mb()
+        memory.update(peak_rss_mb=peak, rss_mb=rss_after,
+                      rss_delta_mb=rss_after - rss_before if rss_after is not None and rss_before is not None else None)
+
+
+@contextlib.contextmanager
+def stage(name):
+    """Add the wall time of the block to stage name of the scan being profiled, if any
+
+    Costs a thread-local lookup when profiling is off. Stages entered several times for a
+    scan accumulate.
+    """
+    stages = getattr(_current, "stages", None)
+    if stages is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stages[name] = stages.get(name, 0.) + time.perf_counter() - start
+
+
+@contextlib.contextmanager
+def profile_scan(cprofile_path=None):
+    """Collect the stage timings of a scan rendered in the block into the yielded dict
+
+    If cprofile_path is given, the block also runs under cProfile and the stats are dumped there.
+    """
+    stages = {}
+    _current.stages = stages
+    profiler = cProfile.Profile() if cprofile_path else None
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield stages
+    finally:
+        _current.stages = None
+        if profiler is not None:
+            profiler.disable()
+            os.makedirs(os.path.dirname(cprofile_path) or ".", exist_ok=True)
+            profiler.dump_stats(cprofile_path)
+
+
+class RenderProfiler:
+    """Writes per-scan stage timings as JSON lines and summarizes them at the end of a run
+
+    Each line is {"scan", "seconds", "stages": {stage: seconds}} with the fields of scan_memory; the summary line
+    is {"summary": {stage: {"count", "mean", "p50", "p90", "p99", "max", "histogram"}}}, with
+    histogram counts over HISTOGRAM_EDGES. The total of each scan is summarized as stage "total".
+
+    Args:
+        path (string): JSON lines file, appended to
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.timings = {}
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.file = open(path, "a")
+
+    def add(self, scan, seconds, stages, memory=None):
+        self.file.write(json.dumps(dict({"scan": scan, "seconds": seconds, "stages": stages}, **(memory or {}))) + "\n")
+        for name, value in list(stages.items()) + [("total", seconds)]:
+            self.timings.setdefault(name, []).append(value)
+
+    def summary(self):
+        summary = {}
+        for name, values in self.timings.items():
+            values = np.asarray(values)
+            p50, p90, p99 = np.percentile(values, [50, 90, 99])
+            counts, _ = np.histogram(values, bins=[0.] + HISTOGRAM_EDGES + [np.inf])
+            summary[name] = {"count": len(values), "mean": float(values.mean()), "p50": float(p50),
+                             "p90": float(p90), "p99": float(p99), "max": float(values.max()),
+                             "histogram": counts.tolist()}
+        return summary
+
+    def close(self):
+        """Write the summary line and close the file; returns the summary"""
+        summary = self.summary()
+        self.file.write(json.dumps({"summary": summary, "histogram_edges": HISTOGRAM_EDGES}) + "\n")
+        self.file.close()
+        return summary
@@ -0,0 +1,158 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+def render_settings(config):
+    """Canonical string of a render config without its fields and elevs
+
+    Arrays rendered with the same settings can be extended with new fields or elevations;
+    any other change to the config makes them stale.
+    """
+    settings = {k: v for k, v in config.items() if k not in ("fields", "elevs")}
+    return json.dumps(settings, sort_keys=True, default=str)
+
+
+def _elev(elev):
+    return round(float(elev), 2)
+
+
+def missing_channels(entry, config):
+    """Fields and elevations of config that a manifest entry does not cover
+
+    Returns:
+        (list, list) or None: fields absent from the entry, which are needed at every elevation,
+            and elevations absent from the entry, which are needed for the recorded fields;
+            None if there is no entry or it was rendered with other settings. Both lists are empty
+            for an entry with the channels of config in another order or with more channels,
+            which is not current; see is_current
+    """
+    if entry is None or entry[2] != render_settings(config):
+        return None
+    fields, elevs, _ = entry
+    recorded_elevs = {_elev(elev) for elev in elevs}
+    return ([field for field in config["fields"] if field not in fields],
+            [elev for elev in config["elevs"] if _elev(elev) not in recorded_elevs])
+
+
+def is_current(entry, config):
+    """Whether a manifest entry holds exactly the fields and elevs of config, in order, with its settings
+
+    Arrays are read by the position of their fields and elevations in array_store.json, so a
+    product with reordered, extra or missing channels must be rebuilt in the order of config.
+    """
+    return missing_channels(entry, config) is not None and list(entry[0]) == list(config["fields"]) and \
+        [_elev(elev) for elev in entry[1]] == [_elev(elev) for elev in config["elevs"]]
+
+
+class RenderManifest:
+    """Record of the fields, elevations and settings each product of each scan was rendered with,
+    and of the outcome of each scan's last rendering job
+
+    Lets rendering find which products of a scan are missing or stale without opening its npz
+    file, and which fields and elevations must be added to bring a product up to date with the
+    current render config. The jobs table holds per-scan status (running, done or failed),
+    error types and messages, consecutive failed attempts, rendering time and output size, replacing the parsing of
+    rendering logs. The database is in WAL mode so that several rendering processes can share it.
+
+    Args:
+        path (string): sqlite file, created if it does not exist, e.g. array_dir/render_manifest.sqlite
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS products ('
+                              'scan TEXT, product TEXT, fields TEXT, elevs TEXT, settings TEXT, rendered_at REAL, '
+                              'PRIMARY KEY (scan, product))')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS jobs ('
+                              'scan TEXT PRIMARY KEY, status TEXT, array_ok INTEGER, dualpol_ok INTEGER, '
+                              'attempts INTEGER DEFAULT 0, error_type TEXT, error TEXT, seconds REAL, '
+                              'output_bytes INTEGER, updated_at REAL)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)')
+
+    def get(self, scan, product):
+        """Returns (fields, elevs, settings) of the recorded product, or None"""
+        with self.lock:
+            row = self.conn.execute('SELECT fields, elevs, settings FROM products WHERE scan = ? AND product = ?',
+                                    (scan, product)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), json.loads(row[1]), row[2]
+
+    def put(self, scan, product, config):
+        """Record that the product of scan now holds the fields and elevs of config"""
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO products VALUES (?, ?, ?, ?, ?, ?)',
+                              (scan, product, json.dumps(list(config["fields"])),
+                               json.dumps([float(elev) for elev in config["elevs"]]),
+                               render_settings(config), time.time()))
+
+    def is_current(self, scan, product, config):
+        return is_current(self.get(scan, product), config)
+
+    def start_jobs(self, scans):
+        """Mark scans as running and count an attempt for each; finish_job resets the count on success"""
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.executemany('INSERT OR IGNORE INTO jobs (scan) VALUES (?)', [(scan,) for scan in scans])
+            self.conn.executemany("UPDATE jobs SET status = 'running', attempts = attempts + 1, updated_at = ? "
+                                  "WHERE scan = ?", [(now, scan) for scan in scans])
+
+    def finish_job(self, scan, array_ok, dualpol_ok, seconds=None, output_bytes=None, errors=None):
+        """Record the outcome of rendering a scan
+
+        Args:
+            errors (dict): (exception type name, message) per failed stage, "load" or a product name
+        """
+        errors = errors or {}
+        error_type = ", ".join(f"{stage}:{name}" for stage, (name, _) in errors.items()) or None
+        error = "; ".join(f"{stage}: {message}" for stage, (_, message) in errors.items()) or None
+        status = "done" if array_ok and dualpol_ok else "failed"
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR IGNORE INTO jobs (scan, attempts) VALUES (?, 1)', (scan,))
+            # attempts counts consecutive failures, so that only scans that keep failing are given up on
+            self.conn.execute('UPDATE jobs SET status = ?, array_ok = ?, dualpol_ok = ?, error_type = ?, error = ?, '
+                              "seconds = ?, output_bytes = ?, updated_at = ?, "
+                              "attempts = CASE WHEN ? = 'done' THEN 0 ELSE attempts END WHERE scan = ?",
+                              (status, int(array_ok), int(dualpol_ok), error_type, error, seconds, output_bytes,
+                               time.time(), status, scan))
+
+    def get_job(self, scan):
+        """Returns the last job of scan as a dict, or None"""
+        with self.lock:
+            cursor = self.conn.execute('SELECT * FROM jobs WHERE scan = ?', (scan,))
+            row = cursor.fetchone()
+        if row is None:
+            return None
+        return dict(zip([column[0] for column in cursor.description], row))
+
+    def job_counts(self):
+        """Returns {status: number of scans}"""
+        with self.lock:
+            return dict(self.conn.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall())
+
+    def failed_scans(self, stage="array"):
+        """Scans whose last job failed at stage ("load", "array" or "dualpol_array"), in name order"""
+        with self.lock:
+            rows = self.conn.execute("SELECT scan FROM jobs WHERE status = 'failed' AND "
+                                     "(',' || REPLACE(error_type, ' ', '') || ',') LIKE ? ORDER BY scan",
+                                     (f"%,{stage}:%",)).fetchall()
+        return [row[0] for row in rows]
+
+    def reset_jobs(self, status="failed"):
+        """Forget the attempts of jobs with status, so that they are rendered again"""
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM jobs WHERE status = ?', (status,))
+
+    def close(self):
+        self.conn.close()
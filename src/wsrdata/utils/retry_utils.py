@@ -0,0 +1,152 @@
+import random
+import threading
+import time
+
+from botocore.exceptions import ClientError, ConnectionError as BotoConnectionError, \
+    HTTPClientError, IncompleteReadError
+
+
+# s3 error codes, see https://docs.aws.amazon.com/AmazonS3/latest/API/ErrorResponses.html
+NOT_FOUND_CODES = {'404', 'NoSuchKey', 'NotFound'}
+THROTTLE_CODES = {'503', 'SlowDown', 'Throttling', 'ThrottlingException', 'RequestLimitExceeded',
+                  '429', 'TooManyRequests'}
+TRANSIENT_CODES = {'500', 'InternalError', 'RequestTimeout', '502', 'BadGateway', '504', 'GatewayTimeout'}
+
+
+def classify_error(err):
+    """Classify an exception raised while talking to s3
+
+    Returns:
+        string: 'not_found', 'throttle', 'transient' (worth retrying) or 'fatal'
+    """
+    if isinstance(err, ClientError):
+        code = str(err.response.get('Error', {}).get('Code'))
+        if code in NOT_FOUND_CODES:
+            return 'not_found'
+        if code in THROTTLE_CODES:
+            return 'throttle'
+        if code in TRANSIENT_CODES:
+            return 'transient'
+        return 'fatal'
+    if isinstance(err, (BotoConnectionError, HTTPClientError, IncompleteReadError, ConnectionError, TimeoutError)):
+        return 'transient'
+    return 'fatal'
+
+
+class RetryPolicy:
+    """Exponential backoff with full jitter: attempt n waits uniformly in [0, min(max_delay, base_delay * 2^n)]
+
+    Args:
+        max_attempts (int): total attempts per call, including the first
+        base_delay (float): seconds
+        max_delay (float): seconds
+        jitter (bool): whether to randomize delays; without jitter the upper bound is used
+    """
+
+    def __init__(self, max_attempts=5, base_delay=0.5, max_delay=30.0, jitter=True):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+
+    def delay(self, attempt):
+        bound = min(self.max_delay, self.base_delay * 2 ** attempt)
+        return random.uniform(0, bound) if self.jitter else bound
+
+
+class AdaptiveLimiter:
+    """Concurrency limit adjusted by additive increase / multiplicative decrease (AIMD)
+
+    Each success raises the limit by 1 / limit, i.e. by about one per round of requests;
+    a throttling response halves it, at most once per cooldown so that a burst of throttled
+    requests that were in flight together counts as a single congestion signal.
+
+    Args:
+        maximum (int): upper bound and initial value of the limit
+        minimum (int): lower bound of the limit
+        cooldown (float): seconds between two decreases
+    """
+
+    def __init__(self, maximum, minimum=1, cooldown=1.0):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.cooldown = cooldown
+        self.limit = float(maximum)
+        self.in_flight = 0
+        self.last_decrease = 0.
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def on_success(self):
+        with self.condition:
+            self.limit = min(self.maximum, self.limit + 1. / self.limit)
+            self.condition.notify_all()
+
+    def on_throttle(self):
+        with self.condition:
+            now = time.time()
+            if now - self.last_decrease >= self.cooldown:
+                self.limit = max(self.minimum, self.limit / 2.)
+                self.last_decrease = now
+
+
+class RetryStats:
+    """Thread-safe counters of retried calls and throttling responses"""
+
+    def __init__(self):
+        self.retries = 0
+        self.throttles = 0
+        self.lock = threading.Lock()
+
+    def add(self, retries=0, throttles=0):
+        with self.lock:
+            self.retries += retries
+            self.throttles += throttles
+
+
+def call_with_retry(fn, policy=None, limiter=None, stats=None):
+    """Call fn(), retrying throttled and transient s3 errors with backoff
+
+    Not-found and other errors are raised right away, as is the last error once
+    policy.max_attempts is reached. If a limiter is given, each attempt holds one of its
+    slots and its outcome adjusts the limit.
+    """
+    if policy is None:
+        policy = RetryPolicy()
+
+    attempt = 0
+    while True:
+        if limiter is not None:
+            limiter.acquire()
+        try:
+            result = fn()
+        except Exception as err:
+            if limiter is not None:
+                limiter.release()
+            kind = classify_error(err)
+            if kind == 'throttle':
+                if stats is not None:
+                    stats.add(throttles=1)
+                if limiter is not None:
+                    limiter.on_throttle()
+            if kind not in ('throttle', 'transient') or attempt + 1 >= policy.max_attempts:
+                raise
+            if stats is not None:
+                stats.add(retries=1)
+            time.sleep(policy.delay(attempt))
+            attempt += 1
+        else:
+            if limiter is not None:
+                limiter.release()
+                limiter.on_success()
+            return result
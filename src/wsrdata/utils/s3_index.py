@@ -0,0 +1,66 @@
+import calendar
+import os
+import sqlite3
+import threading
+import time
+from datetime import timedelta
+
+
+class S3ListingIndex:
+    """Persistent SQLite cache of s3 listings, one row per station and day
+
+    A listing made after its day ended (plus a settle period for late uploads) is final and
+    never expires; listings of recent days are refreshed once they are older than the ttl.
+
+    Args:
+        path (string): sqlite file, created if it does not exist
+        ttl (timedelta): lifetime of listings of days that were not yet final when listed
+        settle (timedelta): delay after the end of a day before its listing is considered final
+    """
+
+    def __init__(self, path, ttl=timedelta(hours=1), settle=timedelta(days=1)):
+        self.path = path
+        self.ttl = ttl.total_seconds()
+        self.settle = settle.total_seconds()
+        self.lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS listings ('
+                              'station TEXT, day TEXT, keys TEXT, listed_at REAL, '
+                              'PRIMARY KEY (station, day))')
+
+    @staticmethod
+    def _day(t):
+        return '%04d/%02d/%02d' % (t.year, t.month, t.day)
+
+    @staticmethod
+    def _day_end(t):
+        # seconds since epoch at the end of the (UTC) day of t
+        return calendar.timegm(t.date().timetuple()) + 86400
+
+    def get(self, station, t):
+        """Return the cached keys of a station on the day of t, or None if missing or expired"""
+        with self.lock:
+            row = self.conn.execute('SELECT keys, listed_at FROM listings WHERE station = ? AND day = ?',
+                                    (station, self._day(t))).fetchone()
+        if row is None:
+            return None
+
+        keys, listed_at = row
+        final = listed_at >= self._day_end(t) + self.settle
+        if not final and time.time() - listed_at > self.ttl:
+            return None
+        return keys.split('\n') if keys else []
+
+    def put(self, station, t, keys):
+        """Record the full listing of a station on the day of t"""
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?)',
+                              (station, self._day(t), '\n'.join(keys), time.time()))
+
+    def close(self):
+        self.conn.close()
@@ -1,9 +1,12 @@
-import boto3
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 import errno
+import json
+import numpy as np
 import os
 import re
 import sys
+import threading
 
 
 ####################################
@@ -87,6 +90,38 @@ def parse_key(key):
     return t, station
 
 
+def nearest_key_indices(key_times, times):
+    """For each query time, find the index of the nearest key time
+
+    Matches a pointer walk over the keys that advances while the next key is at least as close,
+    i.e. ties go to the later key and duplicated timestamps resolve to their last occurrence.
+
+    Args:
+        key_times (np.ndarray): datetime64 timestamps of keys, in listing order
+        times (np.ndarray): sorted datetime64 query times
+
+    Returns:
+        np.ndarray: index into key_times for each query time
+    """
+    n = len(key_times)
+    if np.any(key_times[1:] < key_times[:-1]):
+        # keys out of chronological order, e.g. a station listed twice; walk as the original loop does
+        indices = np.empty(len(times), dtype=np.int64)
+        i = 0
+        for j, t in enumerate(times):
+            while i + 1 < n and not abs(key_times[i] - t) < abs(key_times[i + 1] - t):
+                i = i + 1
+            indices[j] = i
+        return indices
+
+    before = np.searchsorted(key_times, times, side='right') - 1  # last key at or before t
+    after = np.minimum(before + 1, n - 1)
+    after = np.searchsorted(key_times, key_times[after], side='right') - 1  # last of duplicated timestamps
+    take_after = (before < 0) | ((before + 1 < n) &
+                                 (key_times[after] - times <= times - key_times[np.maximum(before, 0)]))
+    return np.where(take_after, after, before)
+
+
 def mkdir_p(path):
     try:
         os.makedirs(path)
@@ -105,12 +140,64 @@ def mkdir_p(path):
 # stations = ['KLIX', 'KLCH', 'KLIX']
 stride_in_minutes = 3
 thresh_in_minutes = 3
-bucket = boto3.resource('s3', region_name='us-east-2').Bucket('noaa-nexrad-level2')
-darkecology_bucket = boto3.resource('s3', region_name='us-east-2').Bucket('cajun-batch-test')
+NEXRAD_BUCKET = 'noaa-nexrad-level2'
+DARKECOLOGY_BUCKET = 'cajun-batch-test'
+
+# keyword arguments of boto3 resource('s3', ...); WSRDATA_S3_ENDPOINT_URL points at a local mirror
+s3_config = {'region_name': 'us-east-2',
+             'endpoint_url': os.environ.get('WSRDATA_S3_ENDPOINT_URL')}
+_thread_local = threading.local()
+
+
+def configure_s3(**kwargs):
+    """Update the options used to create s3 resources, e.g. endpoint_url of a local mirror
+    or config=botocore.config.Config(signature_version=botocore.UNSIGNED) for anonymous access.
+    Buckets handed out afterwards, in any thread, use the new options.
+    """
+    s3_config.update(kwargs)
+
+
+def get_bucket(name=NEXRAD_BUCKET):
+    """Return an s3 Bucket, created on first use and pooled per thread and process
+
+    boto3 sessions are neither thread- nor fork-safe, so each thread of each process gets
+    its own session; nothing is created at import time. Replaces the former module attributes
+    bucket and darkecology_bucket, e.g. get_bucket(DARKECOLOGY_BUCKET).
+    """
+    buckets = getattr(_thread_local, 'buckets', None)
+    if buckets is None:
+        buckets = _thread_local.buckets = {}
+
+    key = (os.getpid(), name, tuple(sorted((k, repr(v)) for k, v in s3_config.items())))
+    if key not in buckets:
+        import boto3
+        options = {k: v for k, v in s3_config.items() if v is not None}
+        buckets[key] = boto3.session.Session().resource('s3', **options).Bucket(name)
+    return buckets[key]
+
+
+def list_prefix(prefix, s3_bucket=None):
+    """List all keys under a prefix, in key order, with paginated list_objects_v2 calls"""
+    if s3_bucket is None:
+        s3_bucket = get_bucket()
+    paginator = s3_bucket.meta.client.get_paginator('list_objects_v2')
+    keys = []
+    for page in paginator.paginate(Bucket=s3_bucket.name, Prefix=prefix):
+        keys.extend(o['Key'] for o in page.get('Contents', []))
+    return keys
 
 
 def get_scans(start_time, end_time, stations, select_by_time=False, time_increment=None, stride_increment=None,
-              thresh_increment=None, with_station=True):
+              thresh_increment=None, with_station=True, listing_index=None, missing_cache=None, list_workers=1):
+    """Select one scan per station for every stride time between start_time and end_time
+
+    Args:
+        listing_index (S3ListingIndex): optional on-disk cache of daily listings; when given,
+            days that are already indexed are not listed again
+        missing_cache (MissingScanCache): optional record of station-days known to have no scans;
+            they are not listed again, and past days found empty are added to it
+        list_workers (int): number of threads listing station-days concurrently, each with its own client
+    """
     #################
     # First get a list of all keys that are within the desired time period
     # and divide by station 
@@ -127,78 +214,223 @@ def get_scans(start_time, end_time, stations, select_by_time=False, time_increme
     if not thresh_increment:
         thresh_increment = timedelta(minutes=thresh_in_minutes)
 
-    for station in stations:
-        for t in datetime_range(start_time, end_time, time_increment, inclusive=True):
-            # Set filter
-            prefix = s3_prefix(t, station)
-            # print prefix
-
-            start_key = s3_key(start_time, station)
-            end_key = s3_key(end_time, station)
+    past_date = (datetime.utcnow() - timedelta(days=1)).date() # listings of earlier days are complete
+
+    def list_day(station, t):
+        # Set filter
+        prefix = s3_prefix(t, station)
+        # print prefix
+
+        # Get s3 objects for this day, from the listing index if possible
+        day_keys = listing_index.get(station, t) if listing_index is not None else None
+        if day_keys is None and missing_cache is not None and prefix in missing_cache:
+            day_keys = []
+        if day_keys is None:
+            day_keys = list_prefix(prefix)
+            if listing_index is not None:
+                listing_index.put(station, t, day_keys)
+            if missing_cache is not None and not day_keys and t.date() < past_date:
+                missing_cache.add(prefix)
+        return day_keys
+
+    # List all station-days, concurrently if requested; results come back in task order
+    tasks = [(station, t) for station in stations
+             for t in datetime_range(start_time, end_time, time_increment, inclusive=True)]
+    if list_workers > 1:
+        with ThreadPoolExecutor(max_workers=list_workers) as executor:
+            listings = list(executor.map(lambda task: list_day(*task), tasks))
+    else:
+        listings = [list_day(*task) for task in tasks]
 
-            # Get s3 objects for this day
-            objects = bucket.objects.filter(Prefix=prefix)
+    for (station, t), day_keys in zip(tasks, listings):
+        start_key = s3_key(start_time, station)
+        end_key = s3_key(end_time, station)
 
-            # Select keys that fall between our start and end time
-            keys = [o.key for o in objects
-                    if o.key >= start_key
-                    and o.key <= end_key]
+        # Select keys that fall between our start and end time
+        keys = [k for k in day_keys
+                if k >= start_key
+                and k <= end_key]
 
-            # Add to running lists
-            all_keys.extend(keys)
-            keys_by_station[station].extend(keys)
+        # Add to running lists
+        all_keys.extend(keys)
+        keys_by_station[station].extend(keys)
     # print(all_keys)
 
     #################
     # Now iterate by time and select the appropriate scan for each station
     #################
-    time_thresh = thresh_increment  # timedelta( minutes = thresh_in_minutes )
+    time_thresh = np.timedelta64(thresh_increment, 'us')  # timedelta( minutes = thresh_in_minutes )
     times = list(datetime_range(start_time, end_time, stride_increment))
-    current = {s: 0 for s in stations}
+    query_times = np.array(times, dtype='datetime64[us]')
     selected_by_time = {t: set() for t in times}
     # selected_by_station = { s: set() for s in stations }
     selected_keys = []
 
-    for t in times:
-        for station in stations:
-            keys = keys_by_station[station]
-            i = current[station]
-
-            if keys:
-                t_current, _ = parse_key(keys[i])
-
-                while i + 1 < len(keys):
-                    t_next, _ = parse_key(keys[i + 1])
-                    if abs(t_current - t) < abs(t_next - t):
-                        break
-                    t_current = t_next
-                    i = i + 1
-
-                current[station] = i
-                k = keys[i]
-
-                if abs(t_current - t) <= time_thresh:
-                    if select_by_time:
-                        selected_by_time[t].add(k)
-                    # selected_by_station[station].add(k)
-                    if with_station:
-                        selected_keys.append("%s;%s" % (k, station))
-                    else:
-                        selected_keys.append(k)
+    # Parse each key once and match all stride times at once, per station
+    selected_by_station = {}
+    for station in set(stations):
+        keys = keys_by_station[station]
+        if not keys or not times:
+            continue
+        key_times = np.array([parse_key(k)[0] for k in keys], dtype='datetime64[us]')
+        indices = nearest_key_indices(key_times, query_times)
+        within = np.abs(key_times[indices] - query_times) <= time_thresh
+        selected_by_station[station] = (np.flatnonzero(within), indices[within])
+
+    # Emit selections ordered by time, then by position in the station list
+    time_order, station_order, key_order = [], [], []
+    for position, station in enumerate(stations):
+        if station in selected_by_station:
+            time_indices, key_indices = selected_by_station[station]
+            time_order.append(time_indices)
+            station_order.append(np.full(len(time_indices), position))
+            key_order.append(key_indices)
+    if time_order:
+        time_order = np.concatenate(time_order)
+        station_order = np.concatenate(station_order)
+        key_order = np.concatenate(key_order)
+        for n in np.lexsort((station_order, time_order)):
+            t = times[time_order[n]]
+            station = stations[station_order[n]]
+            k = keys_by_station[station][key_order[n]]
+            if select_by_time:
+                selected_by_time[t].add(k)
+            if with_station:
+                selected_keys.append("%s;%s" % (k, station))
+            else:
+                selected_keys.append(k)
 
     return selected_keys if not select_by_time else selected_by_time
 
 
-def download_scans(keys, data_dir):
+def read_download_meta(local_file):
+    """Return the {"size", "etag"} recorded for a downloaded file, or None"""
+    try:
+        with open(local_file + '.meta', 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_download_meta(local_file, size, etag):
+    tmp_file = local_file + '.meta.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump({"size": size, "etag": etag}, f)
+    os.replace(tmp_file, local_file + '.meta')
+
+
+def download_object(obj, local_file, chunk_size=1 << 20):
+    """Download an s3 Object atomically, resuming an interrupted transfer when possible
+
+    Data are streamed to local_file.part, which is renamed to local_file once complete.
+    The expected size and ETag are written to local_file.meta before the transfer; a .part
+    file is resumed with a byte range only if the ETag still matches.
+
+    Returns:
+        int: number of bytes transferred
+    """
+    obj.load()  # HEAD request; raises ClientError with code 404 if the key does not exist
+    size, etag = obj.content_length, obj.e_tag
+    part_file = local_file + '.part'
+
+    offset = 0
+    meta = read_download_meta(local_file)
+    if os.path.isfile(part_file):
+        if meta is not None and meta["etag"] == etag and os.path.getsize(part_file) <= size:
+            offset = os.path.getsize(part_file)
+        else:
+            os.remove(part_file)
+    write_download_meta(local_file, size, etag)
+
+    with open(part_file, 'ab' if offset else 'wb') as f:
+        if offset < size:
+            kwargs = {"IfMatch": etag}
+            if offset:
+                kwargs["Range"] = 'bytes=%d-' % offset
+            body = obj.get(**kwargs)['Body']
+            for chunk in iter(lambda: body.read(chunk_size), b''):
+                f.write(chunk)
+
+    if os.path.getsize(part_file) != size:
+        raise ConnectionError('Incomplete download of %s: %d of %d bytes' % (obj.key, os.path.getsize(part_file), size))
+    os.replace(part_file, local_file)
+    return size - offset
+
+
+def fetch_scan(key, s3_bucket=None):
+    """Fetch an s3 object into memory
+
+    Returns:
+        bytes: content of the object
+
+    Raises:
+        ConnectionError: if the body is shorter than the object, which call_with_retry retries
+    """
+    if s3_bucket is None:
+        s3_bucket = get_bucket()
+    response = s3_bucket.Object(key).get()
+    data = response['Body'].read()
+    if len(data) < response.get('ContentLength', len(data)):
+        raise ConnectionError('Incomplete download of %s: %d of %d bytes' % (key, len(data), response['ContentLength']))
+    return data
+
+
+def is_downloaded(local_file, key, s3_bucket, verify_existing=True):
+    # an existing file is complete if it matches its .meta record, or for legacy files without
+    # a record, the size reported by s3 (recording it for next time) unless verification is off
+    meta = read_download_meta(local_file)
+    if meta is not None:
+        return os.path.getsize(local_file) == meta["size"]
+    if not verify_existing:
+        return True
+    obj = s3_bucket.Object(key)
+    obj.load()
+    if os.path.getsize(local_file) == obj.content_length:
+        write_download_meta(local_file, obj.content_length, obj.e_tag)
+        return True
+    return False
+
+
+def download_scans(keys, data_dir, s3_bucket=None, verify_existing=True, scan_cache=None):
+    """Download s3 objects into a local hierarchy mirroring their keys
+
+    Files are written atomically (see download_object). An existing file is accepted without
+    any request if its size matches its .meta record. Files without a record, e.g. downloaded
+    by older versions, are checked against a HEAD request when verify_existing is True and
+    trusted otherwise.
+
+    Args:
+        keys (list): s3 keys, e.g. 2015/05/02/KMPX/KMPX20150502_021525_V06.gz
+        data_dir (string): local root directory
+        s3_bucket: s3 Bucket (or a stand-in exposing Object(key) with load and get); defaults to noaa-nexrad-level2
+        verify_existing (bool): whether to check existing files without a .meta record against s3
+        scan_cache (ScanCache): optional disk-budgeted cache rooted at data_dir that accounts for
+            downloaded and reused files and evicts least recently used scans
+
+    Returns:
+        int: number of bytes downloaded, excluding files that already existed
+    """
+    if s3_bucket is None:
+        s3_bucket = get_bucket()
+
     #################
     # Download files into hierarchy
     #################
+    downloaded_bytes = 0
     for key in keys:
         # Download files
         local_file = os.path.join(data_dir, key)
         local_path, filename = os.path.split(local_file)
         mkdir_p(local_path)
 
-        # Download file if we don't already have it
-        if not os.path.isfile(local_file):
-            bucket.download_file(key, local_file)
+        # Skip files we already have in full
+        if os.path.isfile(local_file) and is_downloaded(local_file, key, s3_bucket, verify_existing):
+            if scan_cache is not None:
+                scan_cache.touch(key)
+            continue
+
+        downloaded_bytes += download_object(s3_bucket.Object(key), local_file)
+        if scan_cache is not None:
+            scan_cache.add(key)
+
+    return downloaded_bytes
@@ -0,0 +1,124 @@
+import os
+import sqlite3
+import threading
+import time
+
+
+class ScanCache:
+    """Disk-budgeted cache of raw scans with least-recently-used eviction
+
+    Scans are identified by their path relative to scan_dir, which is also their s3 key,
+    e.g. 2015/05/02/KMPX/KMPX20150502_021525_V06.gz. Sizes and access times are kept in a
+    small sqlite index so that enforcing the budget never walks the scan tree. Triggers keep a
+    running byte total in the index, so checking the budget costs the same for any number of scans.
+
+    Args:
+        scan_dir (string): root of the scan hierarchy, e.g. static/scans/scans
+        max_bytes (int): byte budget for cached scans
+        index_path (string): sqlite index, default scan_dir/scan_cache.sqlite
+        evict_rendered_only (bool): only evict scans whose arrays have been rendered
+    """
+
+    def __init__(self, scan_dir, max_bytes, index_path=None, evict_rendered_only=False):
+        self.scan_dir = scan_dir
+        self.max_bytes = max_bytes
+        self.evict_rendered_only = evict_rendered_only
+        self.lock = threading.Lock()
+
+        os.makedirs(scan_dir, exist_ok=True)
+        self.index_path = index_path or os.path.join(scan_dir, "scan_cache.sqlite")
+        self.conn = sqlite3.connect(self.index_path, timeout=60, check_same_thread=False)
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS scans ('
+                              'key TEXT PRIMARY KEY, size INTEGER, last_access REAL, rendered INTEGER DEFAULT 0)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS scans_last_access ON scans (last_access)')
+            # running total of sizes; initialized from the scans of an index created before it existed
+            self.conn.execute('CREATE TABLE IF NOT EXISTS totals (id INTEGER PRIMARY KEY CHECK (id = 0), bytes INTEGER)')
+            self.conn.execute('INSERT OR IGNORE INTO totals VALUES (0, (SELECT COALESCE(SUM(size), 0) FROM scans))')
+            self.conn.execute('CREATE TRIGGER IF NOT EXISTS scans_insert AFTER INSERT ON scans BEGIN '
+                              'UPDATE totals SET bytes = bytes + COALESCE(NEW.size, 0); END')
+            self.conn.execute('CREATE TRIGGER IF NOT EXISTS scans_delete AFTER DELETE ON scans BEGIN '
+                              'UPDATE totals SET bytes = bytes - COALESCE(OLD.size, 0); END')
+            self.conn.execute('CREATE TRIGGER IF NOT EXISTS scans_size AFTER UPDATE OF size ON scans BEGIN '
+                              'UPDATE totals SET bytes = bytes + COALESCE(NEW.size, 0) - COALESCE(OLD.size, 0); END')
+
+    def path(self, key):
+        return os.path.join(self.scan_dir, key)
+
+    def add(self, key):
+        """Index a newly downloaded scan and evict other scans if over budget"""
+        size = os.path.getsize(self.path(key))
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR IGNORE INTO scans (key) VALUES (?)', (key,))
+            self.conn.execute('UPDATE scans SET size = ?, last_access = ? WHERE key = ?', (size, time.time(), key))
+        self.evict(protect=(key,))
+
+    def touch(self, key):
+        """Mark a scan as recently used; scans present on disk but not yet indexed are added"""
+        with self.lock, self.conn:
+            updated = self.conn.execute('UPDATE scans SET last_access = ? WHERE key = ?',
+                                        (time.time(), key)).rowcount
+        if not updated and os.path.isfile(self.path(key)):
+            self.add(key)
+
+    def mark_rendered(self, key):
+        with self.lock, self.conn:
+            self.conn.execute('UPDATE scans SET rendered = 1 WHERE key = ?', (key,))
+
+    def total_bytes(self):
+        with self.lock:
+            return self.conn.execute('SELECT bytes FROM totals').fetchone()[0]
+
+    def evict(self, protect=()):
+        """Delete least recently used scans until the cache fits the budget
+
+        Returns:
+            list: keys of evicted scans
+        """
+        evicted = []
+        excess = self.total_bytes() - self.max_bytes
+        if excess <= 0:
+            return evicted
+
+        # least recently used scans in small batches, as evicting one or two is the common case
+        protect = list(protect)
+        query = 'SELECT key, size FROM scans WHERE key NOT IN (%s)' % ', '.join('?' * len(protect))
+        if self.evict_rendered_only:
+            query += ' AND rendered = 1'
+        query += ' ORDER BY last_access LIMIT 16'
+        while excess > 0:
+            with self.lock:
+                candidates = self.conn.execute(query, protect).fetchall()
+            if not candidates:
+                break
+            for key, size in candidates:
+                if excess <= 0:
+                    break
+                for suffix in ('', '.meta', '.part'):
+                    try:
+                        os.remove(self.path(key) + suffix)
+                    except FileNotFoundError:
+                        pass
+                with self.lock, self.conn:
+                    self.conn.execute('DELETE FROM scans WHERE key = ?', (key,))
+                excess -= size or 0
+                evicted.append(key)
+        return evicted
+
+    def rebuild(self):
+        """Index all scans under scan_dir, e.g. when adopting an existing tree; walks the tree once"""
+        rows = []
+        for root, _, files in os.walk(self.scan_dir):
+            for filename in files:
+                if filename.endswith(('.meta', '.part', '.tmp')) or '.sqlite' in filename:
+                    continue
+                path = os.path.join(root, filename)
+                key = os.path.relpath(path, self.scan_dir).replace(os.sep, '/')
+                stat = os.stat(path)
+                rows.append((key, stat.st_size, stat.st_atime))
+        with self.lock, self.conn:
+            self.conn.executemany('INSERT OR IGNORE INTO scans (key, size, last_access) VALUES (?, ?, ?)', rows)
+            self.conn.executemany('UPDATE scans SET size = ? WHERE key = ?', [(size, key) for key, size, _ in rows])
+
+    def close(self):
+        self.conn.close()
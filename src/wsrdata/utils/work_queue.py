@@ -0,0 +1,252 @@
+import contextlib
+import hashlib
+import json
+import os
+import socket
+import threading
+import time
+
+
+class WorkQueue:
+    """Scan lists split into work units that workers on any number of nodes claim through a shared directory
+
+    Needs nothing but a filesystem that all nodes mount (e.g. NFS), with exclusive file creation:
+        queue_dir/queue.json                 the scan list hash and unit size the queue was created with
+        queue_dir/units/00000.txt ...        scan lists of the units
+        queue_dir/leases/00000.3.lease       lease of a unit; 3 is its generation
+        queue_dir/done/00000.json            marker of a completed unit, with what its worker returned
+    A worker claims a unit by creating the lease of the next generation with O_EXCL, so only one of
+    several workers can win a unit. The holder keeps the lease alive by touching it (see heartbeat);
+    a lease that has not been touched for lease_seconds, e.g. because its worker crashed, has
+    expired and the unit can be claimed again with a newer generation. A holder whose lease has
+    been superseded has lost its unit. Node clocks should agree to well within lease_seconds.
+
+    Args:
+        queue_dir (string): shared directory of the queue, created if needed
+        lease_seconds (float): time after which a lease that is not touched expires
+        worker (string): name of this worker in leases and done markers, default host:pid
+    """
+
+    def __init__(self, queue_dir, lease_seconds=600, worker=None):
+        self.queue_dir = queue_dir
+        self.lease_seconds = lease_seconds
+        self.worker = worker or "%s:%d" % (socket.gethostname(), os.getpid())
+        self.held = {} # unit -> path of our lease
+        for name in ("units", "leases", "done"):
+            os.makedirs(os.path.join(queue_dir, name), exist_ok=True)
+
+    def add_scans(self, scans, unit_size=100):
+        """Split scans into units of unit_size, unless the queue already has them
+
+        Every worker can call this with the same scan list; raises ValueError if the queue was
+        created from another scan list or unit size.
+
+        Returns:
+            int: number of units
+        """
+        info = {"scans": len(scans), "unit_size": unit_size,
+                "sha1": hashlib.sha1("\n".join(scans).encode()).hexdigest()}
+        info_path = os.path.join(self.queue_dir, "queue.json")
+        if not os.path.exists(info_path):
+            _write_atomic(info_path, json.dumps(info))
+        with open(info_path, "r") as f:
+            existing = json.load(f)
+        if existing != info:
+            raise ValueError(f"Work queue {self.queue_dir} was created from another scan list: {existing}")
+
+        n_units = (len(scans) + unit_size - 1) // unit_size
+        for i in range(n_units):
+            path = self.unit_path("%05d" % i)
+            if not os.path.exists(path):
+                _write_atomic(path, "".join(scan + "\n" for scan in scans[i * unit_size:(i + 1) * unit_size]))
+        return n_units
+
+    def units(self):
+        return sorted(f[:-4] for f in os.listdir(os.path.join(self.queue_dir, "units")) if f.endswith(".txt"))
+
+    def unit_path(self, unit):
+        """Scan list file of a unit, which can be passed to render_by_scan_list or download_by_scan_list"""
+        return os.path.join(self.queue_dir, "units", unit + ".txt")
+
+    def scans(self, unit):
+        with open(self.unit_path(unit), "r") as f:
+            return [scan.strip() for scan in f if scan.strip()]
+
+    def _done_path(self, unit):
+        return os.path.join(self.queue_dir, "done", unit + ".json")
+
+    def _lease_path(self, unit, generation):
+        return os.path.join(self.queue_dir, "leases", "%s.%d.lease" % (unit, generation))
+
+    def _leases(self):
+        # unit -> generation of its newest lease
+        leases = {}
+        for f in os.listdir(os.path.join(self.queue_dir, "leases")):
+            if f.endswith(".lease"):
+                unit, generation = f[:-6].rsplit(".", 1)
+                leases[unit] = max(leases.get(unit, 0), int(generation))
+        return leases
+
+    def _expired(self, path):
+        try:
+            return time.time() - os.stat(path).st_mtime > self.lease_seconds
+        except FileNotFoundError:
+            return True
+
+    def claim(self):
+        """Lease the first unit that is neither done nor leased, or whose lease expired
+
+        Returns:
+            string: the claimed unit, or None if there is none to claim now
+        """
+        leases = self._leases()
+        for unit in self.units():
+            if os.path.exists(self._done_path(unit)):
+                continue
+            generation = leases.get(unit, 0)
+            if generation and not self._expired(self._lease_path(unit, generation)):
+                continue
+            path = self._lease_path(unit, generation + 1)
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError: # another worker claimed it first
+                continue
+            with os.fdopen(fd, "w") as f:
+                f.write(json.dumps({"worker": self.worker, "claimed_at": time.time()}))
+            if os.path.exists(self._done_path(unit)): # completed by the holder of the expired lease meanwhile
+                os.remove(path)
+                continue
+            if generation:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(self._lease_path(unit, generation))
+            self.held[unit] = path
+            return unit
+        return None
+
+    def _superseded(self, unit):
+        # whether another worker has claimed a held unit since, or its lease was removed
+        path = self.held[unit]
+        generation = int(path[:-6].rsplit(".", 1)[1])
+        return os.path.exists(self._lease_path(unit, generation + 1)) or not os.path.exists(path)
+
+    def touch(self, unit):
+        """Renew the lease of a held unit; returns False if the lease was lost to another worker"""
+        path = self.held[unit]
+        if self._superseded(unit):
+            return False
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    @contextlib.contextmanager
+    def heartbeat(self, unit, interval=None):
+        """Touch the lease of unit from a background thread while the block runs
+
+        Yields a dict whose "lost" is set if the lease is lost, e.g. because the process stalled
+        for longer than lease_seconds.
+        """
+        state = {"lost": False}
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(interval or self.lease_seconds / 4.):
+                if not self.touch(unit):
+                    state["lost"] = True
+                    return
+
+        thread = threading.Thread(target=beat, daemon=True)
+        thread.start()
+        try:
+            yield state
+        finally:
+            stop.set()
+            thread.join()
+
+    def complete(self, unit, result=None):
+        """Mark a held unit as done, recording result (json serializable), and drop its lease
+
+        Returns False, without marking the unit, if its lease was lost to another worker, whose
+        done marker must not be overwritten.
+        """
+        if self._superseded(unit):
+            self.held.pop(unit)
+            return False
+        _write_atomic(self._done_path(unit), json.dumps({"worker": self.worker, "completed_at": time.time(),
+                                                         "result": result}))
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.held.pop(unit))
+        return True
+
+    def release(self, unit):
+        """Give up a held unit without completing it, so that any worker can claim it right away"""
+        path = self.held.pop(unit)
+        with contextlib.suppress(FileNotFoundError):
+            os.utime(path, (0, 0)) # expired; the generation is kept so that the next claim supersedes it
+
+    def results(self):
+        """Returns {unit: result} of the completed units"""
+        results = {}
+        for unit in self.units():
+            with contextlib.suppress(FileNotFoundError):
+                with open(self._done_path(unit), "r") as f:
+                    results[unit] = json.load(f)["result"]
+        return results
+
+    def status(self):
+        """Returns counts of units that are done, leased, and pending (never claimed or lease expired)"""
+        leases = self._leases()
+        counts = {"done": 0, "leased": 0, "pending": 0}
+        for unit in self.units():
+            if os.path.exists(self._done_path(unit)):
+                counts["done"] += 1
+            elif unit in leases and not self._expired(self._lease_path(unit, leases[unit])):
+                counts["leased"] += 1
+            else:
+                counts["pending"] += 1
+        return counts
+
+
+def _write_atomic(path, text):
+    tmp_path = "%s.%s.%d.tmp" % (path, socket.gethostname(), os.getpid())
+    with open(tmp_path, "w") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def run_worker(queue, process, wait=True, poll_seconds=None):
+    """Claim and process units of a WorkQueue until all are done
+
+    process(unit, scan_list_path) is called for each claimed unit, under a heartbeat, and what it
+    returns is recorded in the unit's done marker. If it raises, the unit is released and the
+    exception propagates. If the lease of the unit is lost meanwhile, e.g. because the process
+    stalled and another worker took the unit over, the unit is left to that worker and this
+    worker stops. With wait, the worker keeps polling while other workers hold units, so
+    that it takes over the units of workers that crash; otherwise it returns as soon as there
+    is nothing to claim.
+
+    Returns:
+        list: units processed by this worker
+    """
+    processed = []
+    while True:
+        unit = queue.claim()
+        if unit is None:
+            status = queue.status()
+            if wait and status["leased"] + status["pending"] > 0:
+                time.sleep(poll_seconds or queue.lease_seconds / 4.)
+                continue
+            return processed
+        try:
+            with queue.heartbeat(unit) as state:
+                result = process(unit, queue.unit_path(unit))
+        except BaseException:
+            queue.release(unit)
+            raise
+        if state["lost"]:
+            queue.held.pop(unit)
+            return processed
+        if not queue.complete(unit, result):
+            return processed
+        processed.append(unit)
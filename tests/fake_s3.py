@@ -0,0 +1,67 @@
+"""Local stand-in for an s3 Bucket that injects errors, for testing downloads without network access"""
+import hashlib
+import io
+import threading
+
+from botocore.exceptions import ClientError
+
+
+def client_error(code, operation="GetObject"):
+    return ClientError({"Error": {"Code": code, "Message": code}}, operation)
+
+
+class FakeBucket:
+    """Bucket of in-memory objects exposing what download_scans and fetch_scan use
+
+    Args:
+        objects (dict): key -> bytes
+        faults (dict): key -> list of faults, each consumed by one request (HEAD or GET) for the key:
+            an s3 error code such as "SlowDown" or "InternalError" is raised as a ClientError,
+            "truncate" makes a GET return only half of the requested bytes, and None passes
+    """
+
+    def __init__(self, objects, faults=None, name="fake-bucket"):
+        self.name = name
+        self.objects = dict(objects)
+        self.faults = {key: list(faults) for key, faults in (faults or {}).items()}
+        self.requests = [] # (method, key, Range) of every request
+        self.lock = threading.Lock()
+
+    def Object(self, key):
+        return FakeObject(self, key)
+
+    def _request(self, method, key, byte_range=None):
+        # the fault injected into this request, if any; raises injected and not-found errors
+        with self.lock:
+            self.requests.append((method, key, byte_range))
+            fault = self.faults[key].pop(0) if self.faults.get(key) else None
+        if fault is not None and fault != "truncate":
+            raise client_error(fault, "HeadObject" if method == "HEAD" else "GetObject")
+        if key not in self.objects:
+            raise client_error("404" if method == "HEAD" else "NoSuchKey")
+        return fault
+
+
+class FakeObject:
+
+    def __init__(self, bucket, key):
+        self.bucket = bucket
+        self.key = key
+
+    def load(self):
+        self.bucket._request("HEAD", self.key)
+        data = self.bucket.objects[self.key]
+        self.content_length = len(data)
+        self.e_tag = '"%s"' % hashlib.md5(data).hexdigest()
+
+    def get(self, IfMatch=None, Range=None):
+        fault = self.bucket._request("GET", self.key, Range)
+        data = self.bucket.objects[self.key]
+        if IfMatch is not None and IfMatch != '"%s"' % hashlib.md5(data).hexdigest():
+            raise client_error("PreconditionFailed")
+        if Range is not None:
+            data = data[int(Range[len("bytes="):].rstrip("-")):]
+        length = len(data)
+        if fault == "truncate":
+            data = data[:length // 2]
+        return {"Body": io.BytesIO(data), "ContentLength": length}
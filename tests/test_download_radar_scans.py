@@ -0,0 +1,81 @@
+import gzip
+import os
+
+from fake_s3 import FakeBucket
+from wsrdata.download_radar_scans import download_by_scan_list, scan_to_aws_key
+from wsrdata.utils.retry_utils import AdaptiveLimiter, RetryPolicy
+
+SCANS = ["KOKX20130721_0933%02d_V06" % i for i in range(5)]
+KEYS = [scan_to_aws_key(scan + ".gz") for scan in SCANS]
+
+
+def make_bucket():
+    # SCANS[4] is not in the bucket; the others fail as follows before succeeding, or for good
+    objects = {key: gzip.compress(os.urandom(4096) + key.encode()) for key in KEYS[:4]}
+    faults = {KEYS[0]: ["SlowDown", "SlowDown"], # throttled twice
+              KEYS[1]: [None, "truncate"], # HEAD passes, the first GET is cut short
+              KEYS[2]: ["AccessDenied"], # not retried
+              KEYS[3]: ["InternalError"]} # transient
+    return objects, FakeBucket(objects, faults)
+
+
+def download(tmp_path, bucket, workers):
+    scan_list = tmp_path / "scans.txt"
+    scan_list.write_text("\n".join(SCANS) + "\n")
+    out_dir = tmp_path / "scans"
+    result = download_by_scan_list(str(scan_list), str(out_dir), str(tmp_path / "download.log"),
+                                   str(tmp_path / "not_s3.log"), str(tmp_path / "error_scans.log"),
+                                   workers=workers, s3_bucket=bucket, retry_policy=RetryPolicy(base_delay=0.001))
+    return result, out_dir
+
+
+def check(tmp_path, workers):
+    objects, bucket = make_bucket()
+    result, out_dir = download(tmp_path, bucket, workers)
+
+    assert result["not_s3"] == [SCANS[4] + ".gz"]
+    assert result["error_scans"] == [SCANS[2] + ".gz"]
+    assert (tmp_path / "not_s3.log").read_text().split() == [SCANS[4] + ".gz"]
+    assert (tmp_path / "error_scans.log").read_text().split() == [SCANS[2] + ".gz"]
+    assert result["stats"]["retries"] == 4
+    assert result["stats"]["throttles"] == 2
+    assert result["stats"]["scans"] == 3
+    for key in (KEYS[0], KEYS[1], KEYS[3]):
+        assert (out_dir / key).read_bytes() == objects[key]
+        assert not os.path.exists(str(out_dir / key) + ".part")
+    assert not (out_dir / KEYS[2]).exists()
+
+    # the truncated transfer is resumed from where it stopped
+    gets = [byte_range for method, key, byte_range in bucket.requests if method == "GET" and key == KEYS[1]]
+    assert gets == [None, "bytes=%d-" % (len(objects[KEYS[1]]) // 2)]
+    return bucket
+
+
+def test_retries_and_missing_scans(tmp_path):
+    check(tmp_path, workers=1)
+
+
+def test_retries_and_missing_scans_concurrently(tmp_path):
+    check(tmp_path, workers=4)
+
+
+def test_existing_scans_are_not_requested_again(tmp_path):
+    bucket = check(tmp_path, workers=1)
+    requests = len(bucket.requests)
+    result, _ = download(tmp_path, bucket, workers=1)
+    assert result["stats"]["bytes"] == len(bucket.objects[KEYS[2]]) # AccessDenied was a single fault
+    # downloaded scans have a .meta record, so only the two scans that failed are requested
+    assert {key for _, key, _ in bucket.requests[requests:]} == {KEYS[2], KEYS[4]}
+
+
+def test_adaptive_limiter_halves_on_throttle_and_recovers():
+    limiter = AdaptiveLimiter(8, cooldown=60)
+    limiter.on_throttle()
+    limiter.on_throttle() # within the cooldown, a single congestion signal
+    assert limiter.limit == 4
+    for _ in range(4):
+        limiter.on_success()
+    assert 4.9 < limiter.limit < 5
+    for _ in range(100):
+        limiter.on_success()
+    assert limiter.limit == 8
@@ -0,0 +1,92 @@
+import random
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from wsrdata.utils.s3_utils import datetime_range, get_scans, nearest_key_indices, parse_key, s3_key, s3_prefix
+
+
+class ListingIndex:
+    """Stand-in for S3ListingIndex serving fixed daily listings"""
+
+    def __init__(self, keys):
+        self.keys = keys
+
+    def get(self, station, t):
+        return [key for key in self.keys if key.startswith(s3_prefix(t, station))]
+
+    def put(self, station, t, keys):
+        raise AssertionError("all days are indexed")
+
+
+def pointer_walk_selection(keys, start_time, end_time, stations, select_by_time, stride_increment,
+                           thresh_increment, with_station):
+    # selection of get_scans before it was vectorized, over the same listings
+    keys_by_station = {s: [] for s in stations}
+    for station in stations:
+        for t in datetime_range(start_time, end_time, timedelta(days=1), inclusive=True):
+            day_keys = ListingIndex(keys).get(station, t)
+            keys_by_station[station].extend(k for k in day_keys
+                                            if s3_key(start_time, station) <= k <= s3_key(end_time, station))
+
+    times = list(datetime_range(start_time, end_time, stride_increment))
+    current = {s: 0 for s in stations}
+    selected_by_time = {t: set() for t in times}
+    selected_keys = []
+    for t in times:
+        for station in stations:
+            keys = keys_by_station[station]
+            i = current[station]
+            if keys:
+                t_current, _ = parse_key(keys[i])
+                while i + 1 < len(keys):
+                    t_next, _ = parse_key(keys[i + 1])
+                    if abs(t_current - t) < abs(t_next - t):
+                        break
+                    t_current = t_next
+                    i = i + 1
+                current[station] = i
+                k = keys[i]
+                if abs(t_current - t) <= thresh_increment:
+                    if select_by_time:
+                        selected_by_time[t].add(k)
+                    if with_station:
+                        selected_keys.append("%s;%s" % (k, station))
+                    else:
+                        selected_keys.append(k)
+    return selected_keys if not select_by_time else selected_by_time
+
+
+def random_keys(rng, stations, start_time, days):
+    # listings in key order with irregular scan times, duplicated timestamps and exact ties
+    keys = []
+    for station in stations:
+        t = start_time - timedelta(minutes=30)
+        while t < start_time + timedelta(days=days):
+            t += timedelta(seconds=rng.choice([30, 90, 150, 180, 240, 270, 600]))
+            suffixes = ["_V06.gz", "_V06_MDM.gz"] if rng.random() < 0.1 else [rng.choice(["_V06.gz", ".gz"])]
+            keys.extend(s3_key(t, station) + suffix for suffix in suffixes)
+    return sorted(keys)
+
+
+def test_get_scans_matches_pointer_walk():
+    rng = random.Random(0)
+    start_time = datetime(2015, 5, 1, 23, 0, 0)
+    for trial in range(20):
+        stations = rng.sample(["KOKX", "KTBW", "KMPX", "KLIX"], rng.randint(1, 3))
+        if trial % 4 == 0:
+            stations.append(stations[0]) # a station listed twice has keys out of order
+        keys = random_keys(rng, stations, start_time, days=2)
+        end_time = start_time + timedelta(hours=rng.choice([1, 6, 26]), seconds=rng.choice([0, 15]))
+        kwargs = dict(select_by_time=bool(trial % 2), stride_increment=timedelta(minutes=rng.choice([1, 3, 5])),
+                      thresh_increment=timedelta(minutes=rng.choice([1, 2, 3])), with_station=trial % 3 != 0)
+        expected = pointer_walk_selection(keys, start_time, end_time, stations, **kwargs)
+        assert get_scans(start_time, end_time, stations, listing_index=ListingIndex(keys), **kwargs) == expected
+
+
+def test_nearest_key_indices_ties_go_to_the_later_key():
+    key_times = np.array(["2015-05-02T00:00", "2015-05-02T00:04", "2015-05-02T00:04", "2015-05-02T00:10"],
+                         dtype="datetime64[us]")
+    times = np.array(["2015-05-01T23:50", "2015-05-02T00:02", "2015-05-02T00:07", "2015-05-02T00:20"],
+                     dtype="datetime64[us]")
+    assert nearest_key_indices(key_times, times).tolist() == [0, 2, 3, 3]
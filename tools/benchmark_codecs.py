@@ -0,0 +1,47 @@
+"""
+This script compares compression codecs for rendered arrays on real npz files of an array version:
+compression ratio and encode/decode MB/s of wsrdata.utils.array_io.save_arrays and load_arrays.
+Codecs whose packages are not installed (zstandard, lz4, blosc) are reported and skipped.
+Set ARRAY_CODEC in the dataset preparation script to the chosen codec.
+"""
+
+import argparse
+import os
+from wsrdata.utils.array_io import ArrayReader, STORAGE_DTYPES, benchmark_codec, get_codec, \
+    load_scan, storage_params
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--array_dir", type=str, required=True, help="array version directory, e.g. ../static/arrays/v0.2.0")
+parser.add_argument("--n_scans", type=int, default=20, help="number of npz files to sample")
+parser.add_argument("--codecs", type=str, default="zlib,none,zstd,lz4,blosc")
+parser.add_argument("--storage_dtype", type=str, default=None, choices=STORAGE_DTYPES,
+                    help="optionally quantize arrays before compression")
+parser.add_argument("--repeat", type=int, default=3)
+args = parser.parse_args()
+
+# sample the first n_scans npz files in the tree, walking only as far as needed
+scans = []
+for root, dirs, files in os.walk(args.array_dir):
+    dirs.sort() # visited in order
+    scans += sorted(f[:-4] for f in files if f.endswith(".npz"))
+    if len(scans) >= args.n_scans:
+        break
+scans = scans[:args.n_scans]
+samples = [load_scan(args.array_dir, scan) for scan in scans]
+print(f"Loaded {len(samples)} scans from {args.array_dir}")
+
+storage = None
+if args.storage_dtype:
+    products = ArrayReader(args.array_dir).products
+    assert products, "quantizing needs the product fields recorded in array_store.json of the array directory"
+    storage = {product: storage_params(products[product]["fields"], args.storage_dtype) for product in products}
+
+print(f"{'codec':<8}{'ratio':>8}{'encode MB/s':>14}{'decode MB/s':>14}")
+for codec in args.codecs.split(","):
+    try:
+        get_codec(codec)
+    except ImportError as ex:
+        print(f"{codec:<8}skipped - {ex}")
+        continue
+    result = benchmark_codec(codec, samples, storage, args.repeat)
+    print(f"{codec:<8}{result['ratio']:>8.2f}{result['encode_mb_s']:>14.1f}{result['decode_mb_s']:>14.1f}")
@@ -1,7 +1,7 @@
 import os
-import numpy as np
 import json
 from wsrlib import pyart
+from wsrdata.utils.array_io import ArrayReader
 import matplotlib.pyplot as plt
 import matplotlib.colors as pltc
 from matplotlib import image
@@ -32,6 +32,7 @@ for scan in dataset["scans"]:
     scan_to_id[scan["key"]] = scan["id"]
 attributes = dataset["info"]["array_fields"]
 elevations = dataset["info"]["array_elevations"]
+reader = ArrayReader(dataset["info"]["array_dir"], products={"array": {"fields": attributes, "elevs": elevations}})
 
 # plot
 for scan_list in SCAN_LIST_PATHS:
@@ -40,13 +41,16 @@ for scan_list in SCAN_LIST_PATHS:
     for n, SCAN in enumerate(scans):
         if n % 1000 == 0:
             print(f"Processing the {n+1}th scan")
-        scan = dataset["scans"][scan_to_id[SCAN]]
-        array = np.load(os.path.join(dataset["info"]["array_dir"], scan["array_path"]))["array"]
-
+        # npz arrays are inflated whole, so read them once per scan; npy arrays are read one channel at a time
+        array = reader.read(SCAN, "array") if reader.backend == "npz" else None
         for channel in CHANNELS:
             attr = channel[0]
             elev = channel[1]
             cm = plt.get_cmap(pyart.config.get_field_colormap(attr))
-            rgb = cm(NORMALIZERS[attr](array[attributes.index(attr), elevations.index(elev), :, :]))
+            if array is not None:
+                data = array[attributes.index(attr), elevations.index(elev), :, :]
+            else:
+                data = reader.channel(SCAN, attr, elev)
+            rgb = cm(NORMALIZERS[attr](data))
             rgb = rgb[::-1, :, :3]  # flip the y axis; omit the fourth alpha dimension, NAN are black but not white
             image.imsave(os.path.join(CHANNELS[channel], SCAN+".png"), rgb)
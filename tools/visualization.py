@@ -2,11 +2,14 @@ import os
 import numpy as np
 import json
 from wsrlib import pyart, radar2mat
+from wsrdata.lazy_arrays import LazyArrays
 from wsrdata.utils.bbox_utils import scale_XYWH_box
 import matplotlib.pyplot as plt
 import matplotlib.colors as pltc
 OUTPUT_DIR = None # if not None, save all figures directly under this
 OUTPUT_ROOT = None # if not None, create subdirectories {year}/{month}/{date}/{station} to save figures
+SCAN_DIR = "../static/scans/scans" # raw scans to render channels from when a scan has no arrays in array_dir
+FETCH_SCANS = False # whether to fetch raw scans missing from SCAN_DIR from s3 for rendering
 
 # define which channels for which scans to visualize, which json to be the source of annotations
 CHANNELS = [("reflectivity", 0.5), ("reflectivity", 1.5), ("velocity", 0.5)]
@@ -51,6 +54,12 @@ for scan in dataset["scans"]:
     scan_to_id[scan["key"]] = scan["id"]
 attributes = dataset["info"]["array_fields"]
 elevations = dataset["info"]["array_elevations"]
+def render_config():
+    # only needed for scans without arrays in array_dir
+    with open("../static/arrays/previous_versions.json", "r") as f:
+        return json.load(f)[dataset["info"]["array_version"]]["array"]
+arrays = LazyArrays(render_config, dataset["info"]["array_dir"], SCAN_DIR, fetch=FETCH_SCANS,
+                    products={"array": {"fields": attributes, "elevs": elevations}})
 
 # plot
 for scan_list in SCAN_LIST_PATHS:
@@ -59,7 +68,6 @@ for scan_list in SCAN_LIST_PATHS:
     for n, SCAN in enumerate(scans):
         print(f"Processing the {n+1}th scan")
         scan = dataset["scans"][scan_to_id[SCAN]]
-        array = np.load(os.path.join(dataset["info"]["array_dir"], scan["array_path"]))["array"]
 
         fig, axs = plt.subplots(int(np.ceil(len(CHANNELS)/3)), 3,
                                 figsize=(21, 7*int(np.ceil(len(CHANNELS)/3))),
@@ -69,7 +77,7 @@ for scan_list in SCAN_LIST_PATHS:
             subplt.axis('off')
             subplt.set_title(f"{attr}, elev: {elev}", fontsize=18)
             cm = plt.get_cmap(pyart.config.get_field_colormap(attr))
-            rgb = cm(NORMALIZERS[attr](array[attributes.index(attr), elevations.index(elev), :, :]))
+            rgb = cm(NORMALIZERS[attr](arrays.get_array(SCAN, [attr], [elev])[0, 0]))
             rgb = rgb[:, :, :3]  # omit the fourth alpha dimension, NAN are black but not white
             subplt.imshow(rgb, origin='lower')
             for annotation_id in scan["annotation_ids"]: